@@ -0,0 +1,92 @@
+"""Decoding microbenchmark.
+
+Compare the decoding of zigbee2mqtt snzb02p payloads by the former path of
+the sensor handler (bytes decoded to str, json.loads to a dict, key lookups)
+with automations.decoders, using the json and orjson (when installed)
+backends, and report the size of the decoded objects.
+
+    python benchmarks/bench_decode.py --number 200000
+"""
+
+import argparse
+import json
+from pathlib import Path
+import sys
+from timeit import repeat
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import automations.decoders as decoders  # noqa: E402
+
+PAYLOAD = json.dumps({
+    "battery": 100, "humidity": 55.3, "linkquality": 120, "temperature": 21.7,
+    "update": {"installed_version": -1, "latest_version": -1, "state": None},
+    "voltage": 3000,
+}).encode()
+
+MALFORMED = b'{"battery": 100, "linkquality": 120'
+
+
+def _former(payload: bytes):
+    data = json.loads(payload.decode())
+    try:
+        return data["humidity"], data["temperature"]
+    except KeyError:
+        return None
+
+
+def _decoders(payload: bytes):
+    record = decoders.decode("snzb02p", payload)
+    if record is None:
+        return None
+    return record.humidity, record.temperature
+
+
+def _bench(func, payload: bytes, number: int) -> float:
+    """Best time per call in microseconds"""
+    return min(repeat(lambda: func(payload), number=number, repeat=5)) / number * 1e6
+
+
+def _retained(func, count: int) -> float:
+    """Memory retained by `count` decoded objects, in bytes per object"""
+    tracemalloc.start()
+    objects = [func(PAYLOAD) for _ in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return size / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=100000, help="calls per measure")
+    args = parser.parse_args()
+
+    backends = {"json": json.loads}
+    try:
+        import orjson
+        backends["orjson"] = orjson.loads
+    except ImportError:
+        print("orjson is not installed, only the json backend is measured")
+
+    former = _bench(_former, PAYLOAD, args.number)
+    print(f"{'path':<24} {'valid':>10} {'malformed':>10}  speedup")
+    print(f"{'json.loads(str) + dict':<24} {former:8.2f} us {'':>10}  1.00x")
+    for name, loads in backends.items():
+        decoders._loads = loads
+        valid = _bench(_decoders, PAYLOAD, args.number)
+        malformed = _bench(_decoders, MALFORMED, args.number)
+        print(
+            f"{'decoders (' + name + ')':<24} {valid:8.2f} us {malformed:7.2f} us"
+            f"  {former / valid:.2f}x"
+        )
+
+    decoders._loads = backends[decoders.BACKEND]
+    print()
+    print(f"dict retained           {_retained(lambda p: json.loads(p), 10000):6.0f} B")
+    print(f"Snzb02p retained        {_retained(lambda p: decoders.decode('snzb02p', p), 10000):6.0f} B")
+
+
+if __name__ == "__main__":
+    main()
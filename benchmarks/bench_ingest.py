@@ -0,0 +1,236 @@
+"""Ingestion benchmark.
+
+Run the real automations tasks against in-process stand-ins of domio, the
+SMTP server and the MQTT broker, replay synthetic zigbee2mqtt and doorbell
+traffic and report the throughput, the end-to-end latency (message received
+to row committed) and the memory usage.
+
+    python benchmarks/bench_ingest.py --rate 2000 --duration 10
+"""
+
+import argparse
+import asyncio
+import os
+from pathlib import Path
+import resource
+import sys
+import tempfile
+from time import perf_counter
+
+import aiomqtt
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import automations.config as config  # noqa: E402
+import automations.db as db  # noqa: E402
+import automations.outbox as outbox  # noqa: E402
+import automations.rollup as rollup  # noqa: E402
+import automations.router as router  # noqa: E402
+import automations.tasks as tasks  # noqa: E402
+from standins import FakeBroker  # noqa: E402
+from standins import FakeDomio  # noqa: E402
+from standins import SmtpSink  # noqa: E402
+
+CONFIG = """
+[secret]
+env_path = "{tmp}/bench.env"
+env_names = ["MAIL_FROM", "MAIL_TO", "SMTP_USERNAME", "SMTP_PASSWORD"]
+
+[database]
+path = "{tmp}/bench.db"
+batch_size = {batch_size}
+batch_max_age = {batch_max_age}
+
+[mqtt]
+hostname = "localhost"
+port = 1883
+
+[domio]
+hostname = "127.0.0.1"
+port = {domio_port}
+
+[smtp]
+hostname = "127.0.0.1"
+port = {smtp_port}
+
+[logger]
+
+[periodicity]
+outdoor = 1
+pressure = 1
+linky = 1
+
+[[rules]]
+name = "doorbell"
+trigger = {{ topic = "home/doorbell/pressed" }}
+actions = [
+    {{ publish = "home/doorbell/ring", payload = {{ number = 5 }} }},
+    {{ email = "Ding dong !", content = "On sonne à la porte", key = "doorbell" }},
+    {{ insert = "on_off", values = {{ device = "doorbell", state = true }} }},
+]
+"""
+
+ENV = """
+MAIL_FROM="bench@localhost"
+MAIL_TO="bench@localhost"
+SMTP_USERNAME="bench"
+SMTP_PASSWORD="bench"
+"""
+
+
+def _percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+class _Tracer:
+    """Record when each benchmark message is committed: the seq number of a
+    message is carried in the humidity field"""
+
+    def __init__(self):
+        self.sent = {}
+        self.latencies = []
+        self._in_flight = []
+        self._aggregate = rollup.aggregate
+        self._flush = db.flush
+
+    def install(self):
+        rollup.aggregate = self._traced_aggregate
+        db.flush = self._traced_flush
+
+    def uninstall(self):
+        rollup.aggregate = self._aggregate
+        db.flush = self._flush
+
+    def _traced_aggregate(self, buffer):
+        # called by db.flush with the rows being committed
+        for (table, columns), rows in buffer.items():
+            if table == "temperature_humidity":
+                device = columns.index("device")
+                humidity = columns.index("humidity")
+                self._in_flight.extend(
+                    row[humidity] for row in rows if row[device].startswith("bench")
+                )
+        return self._aggregate(buffer)
+
+    async def _traced_flush(self):
+        await self._flush()
+        now = perf_counter()
+        for seq in self._in_flight:
+            self.latencies.append(now - self.sent.pop(int(seq)))
+        self._in_flight.clear()
+
+
+async def _replay(broker: FakeBroker, tracer: _Tracer, args) -> int:
+    tick = 0.01
+    per_tick = args.rate * tick
+    doorbell_per_tick = args.doorbell_rate * tick
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    deadline = start
+    credit = doorbell_credit = 0.0
+    seq = 0
+
+    while deadline - start < args.duration:
+        credit += per_tick
+        while credit >= 1:
+            credit -= 1
+            tracer.sent[seq] = perf_counter()
+            broker.inject(
+                f"zigbee2mqtt/sensor/sonoff/snzb02p/bench{seq % args.devices}",
+                {"battery": 100, "humidity": float(seq), "temperature": 20.0, "linkquality": 120}
+            )
+            seq += 1
+
+        doorbell_credit += doorbell_per_tick
+        while doorbell_credit >= 1:
+            doorbell_credit -= 1
+            broker.inject("home/doorbell/pressed", b"")
+
+        deadline += tick
+        await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+    return seq
+
+
+async def run(args):
+    domio = FakeDomio()
+    smtp = SmtpSink()
+    broker = FakeBroker()
+    tracer = _Tracer()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        domio_port = await domio.start()
+        smtp_port = await smtp.start()
+        Path(tmp, "bench.env").write_text(ENV)
+        Path(tmp, "config.toml").write_text(CONFIG.format(
+            tmp=tmp, batch_size=args.batch_size, batch_max_age=args.batch_max_age,
+            domio_port=domio_port, smtp_port=smtp_port
+        ))
+        config.read(str(Path(tmp, "config.toml")))
+
+        aiomqtt.Client = broker.client
+        tracer.install()
+
+        await db.init()
+        await outbox.init()
+        tasks.init()
+        # let the MQTT task subscribe
+        await asyncio.sleep(0.1)
+
+        rss_before = _rss_mb()
+        start = perf_counter()
+        sent = await _replay(broker, tracer, args)
+        await db.flush()
+        elapsed = perf_counter() - start
+        rss_after = _rss_mb()
+
+        dropped = sum(h.dropped for h in router._handlers)
+        await tasks.close()
+        await outbox.close()
+        await db.close()
+        tracer.uninstall()
+
+        await domio.stop()
+        await smtp.stop()
+
+    latencies = tracer.latencies
+    print(f"messages sent        {sent}")
+    print(f"rows committed       {len(latencies)}")
+    print(f"dropped by router    {dropped}")
+    print(f"throughput           {len(latencies) / elapsed:.0f} rows/s")
+    print(f"latency p50          {_percentile(latencies, 50) * 1000:.1f} ms")
+    print(f"latency p99          {_percentile(latencies, 99) * 1000:.1f} ms")
+    print(f"flushes              {db.stats.flushes}")
+    print(f"max flush latency    {db.stats.max_flush_latency * 1000:.1f} ms")
+    print(f"domio requests       {domio.requests}")
+    print(f"emails / smtp conn.  {len(smtp.messages)} / {smtp.connections}")
+    print(f"mqtt published       {len(broker.published)}")
+    print(f"rss                  {rss_before:.1f} -> {rss_after:.1f} MB")
+    print(f"max rss              {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=1000, help="sensor messages per second")
+    parser.add_argument("--doorbell-rate", type=float, default=0.5, help="doorbell presses per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--batch-max-age", type=float, default=5.0)
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
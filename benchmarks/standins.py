@@ -0,0 +1,159 @@
+"""In-process stand-ins for the services used by the daemon: domio (HTTP),
+an SMTP server and a MQTT broker."""
+
+import asyncio
+import json
+from random import uniform
+
+from aiohttp import web
+import aiomqtt
+
+
+class FakeDomio:
+    """HTTP server answering /linky, /outdoor and /pressure like domio, after
+    `delay` seconds to simulate a slow hub"""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.requests = 0
+        self._east = 1_000_000
+        self._runner = None
+
+    async def _linky(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.delay)
+        self._east += int(uniform(0, 20))
+        return web.json_response({"data": {"east": self._east, "sinsts": int(uniform(100, 3000))}})
+
+    async def _outdoor(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.delay)
+        return web.json_response(
+            {"data": {"humidity": uniform(40, 90), "temperature": uniform(-5, 30)}}
+        )
+
+    async def _pressure(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.delay)
+        return web.json_response({"data": {"pressure": uniform(98000, 103000)}})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        app = web.Application()
+        app.router.add_get("/linky", self._linky)
+        app.router.add_get("/outdoor", self._outdoor)
+        app.router.add_get("/pressure", self._pressure)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        return self._runner.addresses[0][1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class SmtpSink:
+    """Minimal SMTP server accepting any login and storing the messages"""
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        self._server = None
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        writer.write(b"220 sink ESMTP\r\n")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode().strip().upper()
+                if command.startswith(("EHLO", "HELO")):
+                    writer.write(b"250-sink\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+                elif command.startswith("AUTH"):
+                    writer.write(b"235 2.7.0 accepted\r\n")
+                elif command.startswith("DATA"):
+                    writer.write(b"354 go ahead\r\n")
+                    await writer.drain()
+                    data = await reader.readuntil(b"\r\n.\r\n")
+                    self.messages.append(data)
+                    writer.write(b"250 queued\r\n")
+                elif command.startswith("QUIT"):
+                    writer.write(b"221 bye\r\n")
+                    await writer.drain()
+                    break
+                else:
+                    # MAIL, RCPT, RSET, NOOP
+                    writer.write(b"250 ok\r\n")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+
+class _Messages:
+    def __init__(self, queue: asyncio.Queue):
+        self._queue = queue
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._queue.get()
+
+
+class FakeBroker:
+    """Broker stand-in: `client` replaces aiomqtt.Client, and messages sent
+    with `inject` are delivered to the clients subscribed to their topic"""
+
+    def __init__(self):
+        self.published = []
+        self._clients = []
+
+    def client(self, *args, **kwargs):
+        client = _FakeClient(self)
+        self._clients.append(client)
+        return client
+
+    def inject(self, topic: str, payload: dict | bytes):
+        if isinstance(payload, dict):
+            payload = json.dumps(payload).encode()
+        message = aiomqtt.Message(topic, payload, 0, False, 0, None)
+        for client in self._clients:
+            if any(message.topic.matches(f) for f in client.filters):
+                client.queue.put_nowait(message)
+
+
+class _FakeClient:
+    def __init__(self, broker: FakeBroker):
+        self._broker = broker
+        self.filters = []
+        self.queue = asyncio.Queue()
+        self.messages = _Messages(self.queue)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self._broker._clients.remove(self)
+
+    async def subscribe(self, topic, *args, **kwargs):
+        self.filters.append(topic)
+
+    async def unsubscribe(self, topic, *args, **kwargs):
+        self.filters.remove(topic)
+
+    async def publish(self, topic, payload=None, *args, **kwargs):
+        self._broker.published.append((topic, payload))
@@ -1 +0,0 @@
-/usr/bin/sqlite3 /home/domotik/database/domotik.db < /home/domotik/automations/scripts/cleanup.sql
@@ -0,0 +1 @@
+/home/domotik/.local/bin/report -c /home/domotik/.config/domotik/automations.toml "$@"
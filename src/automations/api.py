@@ -0,0 +1,372 @@
+import asyncio
+from contextlib import aclosing
+import csv
+from datetime import datetime
+import io
+import json
+import logging
+from time import time
+
+import automations.archive as archive
+import automations.config as config
+from automations.db import fetch_all
+from automations.db import iterate
+import automations.metrics as metrics
+import automations.rollup as rollup
+
+# table -> (name of the device column or None, value columns)
+TABLES = dict(rollup.SERIES, on_off=("device", ("state",)))
+
+_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+_RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+
+_REQUESTS = metrics.counter(
+    "automations_api_requests_total", "Series queries", ("table", "format")
+)
+
+_runner = None
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _timestamp(text: str) -> int:
+    """Unix timestamp or ISO 8601 date (local time)"""
+    try:
+        return int(text)
+    except ValueError:
+        return int(datetime.fromisoformat(text).timestamp())
+
+
+async def _flatten(batches):
+    async for rows in batches:
+        for row in rows:
+            yield row
+
+
+def _archived(table: str) -> bool:
+    return config.archive.enabled and table in config.archive.tables
+
+
+def _where(start: int, end: int, filters: dict) -> tuple[str, list]:
+    where = "timestamp BETWEEN ? AND ?"
+    args: list = [start, end]
+    for column, value in filters.items():
+        where += f" AND {column} = ?"
+        args.append(value)
+    return where, args
+
+
+async def _rows(table: str, names: list[str], start: int, end: int, filters: dict):
+    """Yield the row batches of a table ordered by timestamp: the archived
+    rows first, then the rows still in the database. `filters` maps column
+    names to the value they must have"""
+    if _archived(table):
+        # the blocks are decoded in a thread, not to block the loop
+        blocks = archive.read(table, names, start, end, filters)
+        try:
+            while (rows := await asyncio.to_thread(next, blocks, None)) is not None:
+                yield rows
+        finally:
+            try:
+                blocks.close()
+            except ValueError:
+                # cancelled while a block is decoded, the generator is closed
+                # when collected
+                pass
+
+    where, args = _where(start, end, filters)
+    batches = iterate(
+        table, names, where, *args, order=("timestamp", "rowid"), size=config.api.chunk_size
+    )
+    async with aclosing(batches):
+        async for rows in batches:
+            yield rows
+
+
+async def _count(table: str, start: int, end: int, filters: dict) -> int:
+    where, args = _where(start, end, filters)
+    ((count,),) = await fetch_all(f"SELECT COUNT(*) FROM {table} WHERE {where}", *args)
+    if _archived(table):
+        count += await asyncio.to_thread(archive.count, table, start, end, filters)
+    return count
+
+
+async def _average(rows, bucket: int, keys: int):
+    """Average the values of the rows by bucket of `bucket` seconds, and by
+    the `keys` first columns after the timestamp (device, source). The rows
+    are ordered by timestamp"""
+    current = None
+    groups: dict[tuple, list] = {}
+    async for row in rows:
+        timestamp = row[0] - row[0] % bucket
+        if timestamp != current:
+            for key, sums in groups.items():
+                yield (current,) + key + tuple(t / n if n else None for t, n in sums)
+            current = timestamp
+            groups = {}
+
+        key = row[1:keys + 1]
+        sums = groups.get(key)
+        if sums is None:
+            sums = groups[key] = [[0.0, 0] for _ in row[keys + 1:]]
+        for i, value in enumerate(row[keys + 1:]):
+            if value is not None:
+                sums[i][0] += value
+                sums[i][1] += 1
+
+    for key, sums in groups.items():
+        yield (current,) + key + tuple(t / n if n else None for t, n in sums)
+
+
+async def _lttb(rows, count: int, points: int, y: int):
+    """Largest triangle three buckets downsampling of `count` rows ordered by
+    timestamp (first column) on column `y`. Only the current and the next
+    buckets are kept in memory"""
+    if points < 3 or count <= points:
+        async for row in rows:
+            yield row
+        return
+
+    every = (count - 2) / (points - 2)
+
+    async def take(n: int) -> list:
+        bucket = []
+        if n > 0:
+            async for row in rows:
+                bucket.append(row)
+                if len(bucket) == n:
+                    break
+        return bucket
+
+    first = await take(1)
+    if not first:
+        return
+    a = first[0]
+    yield a
+
+    current = await take(int(every))
+    for i in range(1, points - 1):
+        if i < points - 2:
+            following = await take(int((i + 1) * every) - int(i * every))
+            target = following
+        else:
+            # the rest of the rows: the last one, or more if rows were
+            # inserted since they were counted
+            following = [row async for row in rows]
+            target = following[-1:]
+        if not current:
+            break
+
+        values = [r for r in target if r[y] is not None]
+        if values:
+            avg_x = sum(r[0] for r in values) / len(values)
+            avg_y = sum(r[y] for r in values) / len(values)
+        else:
+            avg_x, avg_y = current[-1][0], a[y] or 0
+
+        best, best_area = current[0], -1.0
+        for row in current:
+            if row[y] is None:
+                continue
+            area = abs(
+                (a[0] - avg_x) * (row[y] - (a[y] or 0))
+                - (a[0] - row[0]) * (avg_y - (a[y] or 0))
+            )
+            if area > best_area:
+                best, best_area = row, area
+        yield best
+        a = best
+        current = following
+
+    if current:
+        yield current[-1]
+
+
+async def _pivot(rows, columns: tuple):
+    """Pivot the rollup rows (bucket, series, mean, min, max), ordered by
+    bucket and series, to one row per bucket and device or source"""
+    current = None
+    values: dict = {}
+    async for bucket, series, mean, minimum, maximum in rows:
+        parts = series.split(".")
+        key = (bucket, ".".join(parts[1:-1]) or None)
+        if key != current:
+            if current is not None:
+                yield _pivoted(current, columns, values)
+            current = key
+            values = {}
+        values[parts[-1]] = (mean, minimum, maximum)
+
+    if current is not None:
+        yield _pivoted(current, columns, values)
+
+
+def _pivoted(key: tuple, columns: tuple, values: dict) -> tuple:
+    row = list(key)
+    for column in columns:
+        row.extend(values.get(column, (None, None, None)))
+    return tuple(row)
+
+
+async def _query(request) -> tuple:
+    """Return the column names and the generator of row batches of a series
+    request, and the transformation of the rows"""
+    from aiohttp import web
+
+    table = request.match_info["table"]
+    if table not in TABLES:
+        raise web.HTTPNotFound(text=f"unknown table {table}\n")
+    device_column, columns = TABLES[table]
+
+    query = request.query
+    try:
+        end = _timestamp(query["end"]) if "end" in query else int(time())
+        start = _timestamp(query["start"]) if "start" in query else end - 86400
+        bucket = int(query.get("bucket", 0))
+        points = int(query.get("points", 0))
+    except ValueError as exc:
+        raise web.HTTPBadRequest(text=f"{exc}\n")
+    device = query.get("device")
+    if device is not None and device_column is None:
+        raise web.HTTPBadRequest(text=f"{table} has no device\n")
+    # rows of the domio hubs are tagged with their source
+    sourced = table in rollup.SERIES
+    source = query.get("source")
+    if source is not None and not sourced:
+        raise web.HTTPBadRequest(text=f"{table} has no source\n")
+
+    resolution = query.get("resolution")
+    if resolution is not None:
+        # aggregates of the rollup table, kept longer than the raw rows
+        if resolution not in _RESOLUTIONS or table not in rollup.SERIES:
+            raise web.HTTPBadRequest(text=f"no {resolution} aggregates for {table}\n")
+        seconds = _RESOLUTIONS[resolution]
+        prefix = ".".join(p for p in (table, source, device) if p is not None) + "."
+        # the device of the series is prefixed by the source of its hub
+        names = ["timestamp", device_column or "source"]
+        for column in columns:
+            names += [column, f"{column}_min", f"{column}_max"]
+        # series whose name starts with the prefix ("/" follows ".")
+        batches = iterate(
+            "rollup", ["bucket", "series", "sum / count", "min", "max"],
+            "series >= ? AND series < ? AND resolution = ? AND bucket BETWEEN ? AND ?",
+            prefix, prefix[:-1] + "/", seconds, start - start % seconds, end,
+            order=("bucket", "series"), size=config.api.chunk_size
+        )
+        return names, batches, lambda rows: _pivot(rows, columns)
+
+    keys = ([device_column] if device_column else []) + (["source"] if sourced else [])
+    names = ["timestamp"] + keys + list(columns)
+    filters = {}
+    if device is not None:
+        filters[device_column] = device
+    if source is not None:
+        filters["source"] = source
+
+    if bucket > 0:
+        # averaged in the stream, over the archived and the database rows
+        batches = _rows(table, names, start, end, filters)
+        return names, batches, lambda rows: _average(rows, bucket, len(keys))
+
+    if points > 0:
+        if device_column is not None and device is None:
+            raise web.HTTPBadRequest(text="points needs a device\n")
+        column = query.get("column", columns[0])
+        if column not in columns:
+            raise web.HTTPBadRequest(text=f"unknown column {column}\n")
+        points = min(points, config.api.max_points)
+        count = await _count(table, start, end, filters)
+        y = names.index(column)
+        batches = _rows(table, names, start, end, filters)
+        return names, batches, lambda rows: _lttb(rows, count, points, y)
+
+    return names, _rows(table, names, start, end, filters), None
+
+
+def _encode(fmt: str, names: list, rows: list) -> bytes:
+    if fmt == "csv":
+        output = io.StringIO()
+        csv.writer(output).writerows(rows)
+        return output.getvalue().encode()
+    return "".join(json.dumps(dict(zip(names, row))) + "\n" for row in rows).encode()
+
+
+async def _series(request):
+    """Stream the rows of a table in CSV or NDJSON: start and end (unix
+    timestamps or ISO dates, last day by default), device, source, and optionally
+    bucket (seconds, averages), points (LTTB on column) or resolution (minute,
+    hour or day aggregates)"""
+    from aiohttp import web
+
+    fmt = request.query.get("format", "ndjson")
+    if fmt not in _FORMATS:
+        raise web.HTTPBadRequest(text=f"unknown format {fmt}\n")
+
+    names, batches, transform = await _query(request)
+    _REQUESTS.inc(request.match_info["table"], fmt)
+
+    response = web.StreamResponse(headers={"Content-Type": _FORMATS[fmt]})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    if fmt == "csv":
+        await response.write(_encode(fmt, names, [names]))
+
+    # the rows are written as they are read, batch by batch
+    async with aclosing(batches):
+        if transform is None:
+            async for rows in batches:
+                await response.write(_encode(fmt, names, rows))
+        else:
+            chunk = []
+            async for row in transform(_flatten(batches)):
+                chunk.append(row)
+                if len(chunk) >= config.api.chunk_size:
+                    await response.write(_encode(fmt, names, chunk))
+                    chunk = []
+            if chunk:
+                await response.write(_encode(fmt, names, chunk))
+
+    await response.write_eof()
+    return response
+
+
+async def _tables(request):
+    from aiohttp import web
+
+    return web.json_response({
+        table: {
+            "device": device_column, "source": table in rollup.SERIES,
+            "columns": list(columns)
+        }
+        for table, (device_column, columns) in TABLES.items()
+    })
+
+
+async def init():
+    global _runner
+
+    if not config.api.enabled or _runner is not None:
+        return
+
+    # aiohttp.web is only imported when the api is enabled
+    from aiohttp import web
+
+    app = web.Application()
+    app.router.add_get("/series", _tables)
+    app.router.add_get("/series/{table}", _series)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    try:
+        await web.TCPSite(_runner, config.api.hostname, config.api.port).start()
+    except OSError as exc:
+        logger.error(f"unable to start api server ({exc})")
+
+
+async def close():
+    global _runner
+
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
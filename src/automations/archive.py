@@ -0,0 +1,384 @@
+# Columnar archive of the rows removed from the database by the retention.
+# There is one file per table and month (UTC): each retention run appends a
+# block of rows, the columns of a block being encoded one after the other:
+# - timestamps: delta of delta, zigzag varints
+# - integers and booleans: delta, zigzag varints
+# - floats: delta of the values scaled to their decimal precision when they
+#   have one (sensor values), XOR with the previous value otherwise
+# - strings: dictionary and indexes
+# A JSON footer indexes the blocks (offset, row count, time range, column
+# encodings and sizes, row count per value of the string columns), followed
+# by its length and the magic number. The files are read memory-mapped, only
+# the needed blocks and columns are decoded
+
+import json
+import mmap
+import os
+from pathlib import Path
+from struct import Struct
+from time import gmtime
+from time import mktime
+from time import strftime
+from time import strptime
+
+import automations.config as config
+
+_MAGIC = b"DKA1"
+_TAIL = Struct("<I4s")  # footer length, magic
+
+_INT = 0
+_TIMESTAMP = 1
+_DECIMAL = 2
+_XOR = 3
+_STR = 4
+_NULLS = 0x80
+
+_FLOAT = Struct("<d")
+_UINT64 = Struct("<Q")
+
+
+def _zigzag(n: int) -> int:
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def _unzigzag(n: int) -> int:
+    return n >> 1 if not n & 1 else -(n >> 1) - 1
+
+
+def _put_varint(out: bytearray, n: int):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _get_varints(buf, pos: int, count: int) -> tuple[list[int], int]:
+    values = []
+    append = values.append
+    for _ in range(count):
+        n = shift = 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        append(n)
+    return values, pos
+
+
+def _precision(values: list) -> int | None:
+    """Number of decimals of the values, None if they have too many"""
+    for p in range(7):
+        scale = 10 ** p
+        if all(round(v * scale) / scale == v for v in values):
+            return p
+    return None
+
+
+def _encode_deltas(out: bytearray, values: list[int]):
+    previous = 0
+    for v in values:
+        _put_varint(out, _zigzag(v - previous))
+        previous = v
+
+
+def _encode(values: list, timestamp: bool = False) -> tuple[int, str, bytes]:
+    """Encode a column, return its encoding, type and bytes"""
+    out = bytearray()
+    present = [v for v in values if v is not None]
+    encoding = 0
+    if len(present) < len(values):
+        encoding = _NULLS
+        bitmap = bytearray((len(values) + 7) // 8)
+        for i, v in enumerate(values):
+            if v is not None:
+                bitmap[i // 8] |= 1 << (i % 8)
+        out += bitmap
+
+    if all(isinstance(v, bool) for v in present):
+        kind = "bool"
+    elif all(isinstance(v, int) for v in present):
+        kind = "int"
+    elif all(isinstance(v, (int, float)) for v in present):
+        kind = "float"
+    else:
+        kind = "str"
+
+    if timestamp:
+        encoding |= _TIMESTAMP
+        previous = delta = 0
+        for v in present:
+            _put_varint(out, _zigzag(v - previous - delta))
+            delta = v - previous
+            previous = v
+    elif kind in ("bool", "int"):
+        encoding |= _INT
+        _encode_deltas(out, [int(v) for v in present])
+    elif kind == "float":
+        precision = _precision(present)
+        if precision is not None:
+            encoding |= _DECIMAL
+            out.append(precision)
+            scale = 10 ** precision
+            _encode_deltas(out, [round(v * scale) for v in present])
+        else:
+            encoding |= _XOR
+            # byte-aligned XOR: a control byte with the number of leading and
+            # trailing zero bytes of the XOR, then its meaningful bytes
+            previous = 0
+            for v in present:
+                bits = _UINT64.unpack(_FLOAT.pack(v))[0]
+                xor = (bits ^ previous).to_bytes(8, "big")
+                previous = bits
+                stripped = xor.lstrip(b"\0")
+                if not stripped:
+                    out.append(0xff)
+                    continue
+                leading = 8 - len(stripped)
+                meaningful = stripped.rstrip(b"\0")
+                out.append(leading << 4 | (len(stripped) - len(meaningful)))
+                out += meaningful
+    else:
+        encoding |= _STR
+        dictionary: dict[str, int] = {}
+        indexes = [dictionary.setdefault(str(v), len(dictionary)) for v in present]
+        _put_varint(out, len(dictionary))
+        for text in dictionary:
+            data = text.encode()
+            _put_varint(out, len(data))
+            out += data
+        for index in indexes:
+            _put_varint(out, index)
+
+    return encoding, kind, bytes(out)
+
+
+def _decode(buf, encoding: int, kind: str, count: int) -> list:
+    pos = 0
+    mask = None
+    present = count
+    if encoding & _NULLS:
+        size = (count + 7) // 8
+        bitmap = bytes(buf[:size])
+        pos = size
+        mask = [bool(bitmap[i // 8] & (1 << (i % 8))) for i in range(count)]
+        present = sum(mask)
+
+    encoding &= ~_NULLS
+    if encoding == _TIMESTAMP:
+        deltas, pos = _get_varints(buf, pos, present)
+        values = []
+        previous = delta = 0
+        for d in deltas:
+            delta += _unzigzag(d)
+            previous += delta
+            values.append(previous)
+    elif encoding in (_INT, _DECIMAL):
+        scale = 1
+        if encoding == _DECIMAL:
+            scale = 10 ** buf[pos]
+            pos += 1
+        deltas, pos = _get_varints(buf, pos, present)
+        values = []
+        previous = 0
+        for d in deltas:
+            previous += _unzigzag(d)
+            values.append(previous)
+        if kind == "bool":
+            values = [bool(v) for v in values]
+        elif kind == "float":
+            values = [v / scale for v in values]
+    elif encoding == _XOR:
+        values = []
+        previous = 0
+        for _ in range(present):
+            control = buf[pos]
+            pos += 1
+            if control != 0xff:
+                leading, trailing = control >> 4, control & 0x0f
+                size = 8 - leading - trailing
+                xor = int.from_bytes(buf[pos:pos + size], "big") << (8 * trailing)
+                pos += size
+                previous ^= xor
+            values.append(_FLOAT.unpack(_UINT64.pack(previous))[0])
+    else:
+        (size,), pos = _get_varints(buf, pos, 1)
+        dictionary = []
+        for _ in range(size):
+            (length,), pos = _get_varints(buf, pos, 1)
+            dictionary.append(bytes(buf[pos:pos + length]).decode())
+            pos += length
+        indexes, pos = _get_varints(buf, pos, present)
+        values = [dictionary[i] for i in indexes]
+
+    if mask is not None:
+        it = iter(values)
+        values = [next(it) if m else None for m in mask]
+    return values
+
+
+def _path(table: str, month: str) -> Path:
+    return Path(config.archive.path).expanduser() / table / f"{month}.dka"
+
+
+def _month(timestamp: int) -> str:
+    return strftime("%Y-%m", gmtime(timestamp))
+
+
+def _read_footer(mm) -> tuple[dict, int]:
+    """Return the footer of a mapped file and its offset"""
+    length, magic = _TAIL.unpack_from(mm, len(mm) - _TAIL.size)
+    if magic != _MAGIC:
+        raise ValueError("not an archive file")
+    offset = len(mm) - _TAIL.size - length
+    return json.loads(bytes(mm[offset:offset + length])), offset
+
+
+def _append_block(path: Path, names: list[str], rows: list[tuple]):
+    """Append a block of rows, ordered by timestamp, to an archive file. The
+    file is rewritten then renamed, so that it is never left incomplete"""
+    footer = {"blocks": []}
+    data = b""
+    if path.exists():
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                footer, end = _read_footer(mm)
+                data = mm[:end]
+
+    offset = len(data) if data else len(_MAGIC)
+    columns = []
+    chunks = []
+    # rows per value of the string columns (device, source), to count the
+    # filtered rows without decoding the blocks
+    values: dict[str, dict[str, int]] = {}
+    for i, name in enumerate(names):
+        column = [row[i] for row in rows]
+        encoding, kind, chunk = _encode(column, name == "timestamp")
+        columns.append([name, encoding, kind, len(chunk)])
+        chunks.append(chunk)
+        if kind == "str":
+            counts = values[name] = {}
+            for v in column:
+                if v is not None:
+                    counts[str(v)] = counts.get(str(v), 0) + 1
+
+    timestamps = [row[names.index("timestamp")] for row in rows]
+    footer["blocks"].append({
+        "offset": offset,
+        "count": len(rows),
+        "start": min(timestamps),
+        "end": max(timestamps),
+        "columns": columns,
+        "values": values,
+    })
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data or _MAGIC)
+        for chunk in chunks:
+            f.write(chunk)
+        encoded = json.dumps(footer, separators=(",", ":")).encode()
+        f.write(encoded)
+        f.write(_TAIL.pack(len(encoded), _MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def append(table: str, names: list[str], rows: list[tuple]):
+    """Archive rows of `table`, whose columns are `names` (timestamp
+    included)"""
+    index = names.index("timestamp")
+    months: dict[str, list] = {}
+    for row in rows:
+        months.setdefault(_month(row[index]), []).append(row)
+
+    for month, month_rows in sorted(months.items()):
+        month_rows.sort(key=lambda r: r[index])
+        _append_block(_path(table, month), names, month_rows)
+
+
+def months(table: str) -> list[str]:
+    """Return the archived months of a table (YYYY-MM)"""
+    directory = Path(config.archive.path).expanduser() / table
+    return sorted(p.stem for p in directory.glob("*.dka"))
+
+
+def _blocks(table: str, start: int, end: int):
+    """Yield the (mapped file, block) of the archive blocks of `table`
+    overlapping `start` to `end` (included)"""
+    for month in months(table):
+        first = int(mktime(strptime(f"{month}-01", "%Y-%m-%d"))) - 86400
+        if month < _month(start) or first > end:
+            continue
+
+        with open(_path(table, month), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                footer, _ = _read_footer(mm)
+                view = memoryview(mm)
+                try:
+                    for block in footer["blocks"]:
+                        if block["end"] < start or block["start"] > end:
+                            continue
+                        yield view, block
+                finally:
+                    view.release()
+
+
+def read(
+    table: str, names: list[str], start: int, end: int,
+    filters: dict | None = None
+):
+    """Yield the archived rows of `table` between `start` and `end`
+    (included) as lists of tuples of the `names` columns, block by block.
+    `filters` maps column names to the value they must have"""
+    filters = filters or {}
+    for view, block in _blocks(table, start, end):
+        rows = _read_block(view, block, names, start, end, filters)
+        if rows:
+            yield rows
+
+
+def count(table: str, start: int, end: int, filters: dict | None = None) -> int:
+    """Return the number of archived rows of `table` between `start` and
+    `end` (included) matching `filters`. The blocks within the range are
+    counted from the footer, only the timestamps and the filtered columns of
+    the others are decoded"""
+    filters = filters or {}
+    total = 0
+    for view, block in _blocks(table, start, end):
+        if start <= block["start"] and block["end"] <= end:
+            if not filters:
+                total += block["count"]
+                continue
+            values = block.get("values", {})
+            if len(filters) == 1:
+                ((name, value),) = filters.items()
+                if name in values:
+                    total += values[name].get(str(value), 0)
+                    continue
+        total += len(_read_block(view, block, [], start, end, filters))
+    return total
+
+
+def _read_block(view, block: dict, names: list[str], start: int, end: int, filters: dict) -> list:
+    count = block["count"]
+    needed = set(names) | set(filters) | {"timestamp"}
+    columns = {}
+    offset = block["offset"]
+    for name, encoding, kind, size in block["columns"]:
+        if name in needed:
+            columns[name] = _decode(view[offset:offset + size], encoding, kind, count)
+        offset += size
+
+    timestamps = columns["timestamp"]
+    keep = [i for i in range(count) if start <= timestamps[i] <= end]
+    for name, value in filters.items():
+        values = columns.get(name)
+        keep = [i for i in keep if values is not None and values[i] == value]
+
+    values = [columns.get(name, [None] * count) for name in names]
+    return [tuple(column[i] for column in values) for i in keep]
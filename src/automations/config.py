@@ -1,65 +1,195 @@
+from dataclasses import fields
+import logging
 from os import getenv
 from pathlib import Path
 import sys
 import tomllib
+from types import NoneType
 
 from dotenv import load_dotenv
 
+from automations.typem import ApiConfig
+from automations.typem import ArchiveConfig
 from automations.typem import DatabaseConfig
+from automations.typem import DeadbandConfig
+from automations.typem import DiagnosticsConfig
 from automations.typem import DomioConfig
-from automations.typem import LinkyConfig
+from automations.typem import FilterConfig
+from automations.typem import HubConfig
+from automations.typem import MetricsConfig
 from automations.typem import MqttConfig
+from automations.typem import OutboxConfig
 from automations.typem import PeriodicityConfig
+from automations.typem import RegistryConfig
+from automations.typem import ReportsConfig
+from automations.typem import RetentionConfig
+from automations.typem import RuleConfig
 from automations.typem import SecretConfig
 from automations.typem import SmtpConfig
+from automations.typem import SpoolConfig
+from automations.typem import SupervisorConfig
 
+api = None
+archive = None
 database = None
+deadband = None
+diagnostics = None
 domio = None
-linky = None
+filters = None
 loggers = {}
+metrics = None
 mqtt = None
+outbox = None
 periodicity = None
+registry = None
+reports = None
+retention = None
+rules = []
 secret = None
 smtp = None
-
-
-def read(config_filename: str):
+spool = None
+supervisor = None
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+# sections set up once at startup (connections, servers, files): their
+# changes are only taken into account after a restart
+RESTART = ("api", "database", "metrics", "mqtt", "secret", "spool")
+
+
+def _check(section: str, obj):
+    """Check the types of the fields of a configuration dataclass"""
+    for f in fields(obj):
+        value = getattr(obj, f.name)
+        expected = f.type
+        if expected is float or expected == float | None:
+            # integers are valid floats in TOML
+            expected = (int, float) if expected is float else (int, float, NoneType)
+        if isinstance(value, bool) and expected in (int, float, (int, float)):
+            raise ValueError(f"invalid [{section}] {f.name}: {value!r} is not a number")
+        if not isinstance(value, expected):
+            name = getattr(f.type, "__name__", f.type)
+            raise ValueError(f"invalid [{section}] {f.name}: {value!r} is not {name}")
+
+
+def _section(section: str, cls, raw: dict):
+    try:
+        obj = cls(**raw)
+    except TypeError as exc:
+        # unknown or missing keys
+        raise ValueError(f"invalid [{section}]: {exc}") from None
+    _check(section, obj)
+    return obj
+
+
+def load(config_filename: str) -> dict:
+    """Parse and validate a configuration file, return its sections. Raise
+    ValueError if the file is invalid"""
     config_file = Path(config_filename).expanduser()
 
-    with open(config_file, "rb") as f:
-        raw_config = tomllib.load(f)
-
-    global database
-    database = DatabaseConfig(**raw_config["database"])
-
-    global domio
-    domio = DomioConfig(**raw_config["domio"])
+    try:
+        with open(config_file, "rb") as f:
+            raw_config = tomllib.load(f)
+    except tomllib.TOMLDecodeError as exc:
+        raise ValueError(f"invalid {config_file}: {exc}") from None
+
+    sections = {}
+    try:
+        sections["api"] = _section("api", ApiConfig, raw_config.get("api", {}))
+        sections["archive"] = _section("archive", ArchiveConfig, raw_config.get("archive", {}))
+        sections["database"] = _section("database", DatabaseConfig, raw_config["database"])
+        sections["deadband"] = _section(
+            "deadband", DeadbandConfig, raw_config.get("deadband", {})
+        )
+        sections["diagnostics"] = _section(
+            "diagnostics", DiagnosticsConfig, raw_config.get("diagnostics", {})
+        )
+
+        domio = _section("domio", DomioConfig, raw_config["domio"])
+        domio.hubs = [_section("domio.hubs", HubConfig, h) for h in domio.hubs]
+        if not domio.hubs:
+            domio.hubs = [HubConfig("", domio.hostname, domio.port)]
+        sections["domio"] = domio
+
+        sections["filters"] = _section("filters", FilterConfig, raw_config.get("filters", {}))
+        sections["loggers"] = raw_config["logger"]
+        sections["metrics"] = _section("metrics", MetricsConfig, raw_config.get("metrics", {}))
+        sections["mqtt"] = _section("mqtt", MqttConfig, raw_config["mqtt"])
+        sections["outbox"] = _section("outbox", OutboxConfig, raw_config.get("outbox", {}))
+        sections["periodicity"] = _section(
+            "periodicity", PeriodicityConfig, raw_config["periodicity"]
+        )
+        sections["registry"] = _section(
+            "registry", RegistryConfig, raw_config.get("registry", {})
+        )
+        sections["reports"] = _section("reports", ReportsConfig, raw_config.get("reports", {}))
+        sections["retention"] = _section(
+            "retention", RetentionConfig, raw_config.get("retention", {})
+        )
+        sections["rules"] = [_section("rules", RuleConfig, r) for r in raw_config.get("rules", [])]
+        sections["smtp"] = _section("smtp", SmtpConfig, raw_config["smtp"])
+        sections["spool"] = _section("spool", SpoolConfig, raw_config.get("spool", {}))
+        sections["supervisor"] = _section(
+            "supervisor", SupervisorConfig, raw_config.get("supervisor", {})
+        )
+
+        # store secrets data in config class
+        load_dotenv(raw_config["secret"]["env_path"])
+        secret = SecretConfig()
+        for v in raw_config["secret"]["env_names"]:
+            value = getenv(v)
+            if value is None:
+                # not logging system configured yet!
+                sys.stderr.write(f"Missing environment variables {v}\n")
+            setattr(secret, v.lower(), value)
+        sections["secret"] = secret
+    except KeyError as exc:
+        raise ValueError(f"missing section {exc}") from None
+
+    # the doorbell, battery and linky automations used to be built in, they
+    # are rules now: a configuration of the former format would run none
+    if "linky" in raw_config:
+        logger.warning(
+            f"{config_file}: the [linky] section is not used anymore, "
+            "the linky alerts are [[rules]] (see config.toml)"
+        )
+    if not sections["rules"]:
+        logger.warning(
+            f"{config_file}: no [[rules]] configured, the doorbell, battery and "
+            "linky automations are disabled"
+        )
+
+    return sections
 
-    global linky
-    linky = LinkyConfig(**raw_config["linky"])
 
-    global loggers
-    loggers = raw_config["logger"]
-
-    global mqtt
-    mqtt = MqttConfig(**raw_config["mqtt"])
-
-    global periodicity
-    periodicity = PeriodicityConfig(**raw_config["periodicity"])
-
-    global smtp
-    smtp = SmtpConfig(**raw_config["smtp"])
-
-    # store secrets data in config class
-    global secret
-    load_dotenv(raw_config["secret"]["env_path"])
-    secret = SecretConfig()
-    for v in raw_config["secret"]["env_names"]:
-        value = getenv(v)
-        if value is None:
-            # not logging system configured yet!
-            sys.stderr.write(f"Missing environment variables {v}\n")
-        setattr(secret, v.lower(), value)
+def read(config_filename: str):
+    globals().update(load(config_filename))
+
+
+def _differs(old, new) -> bool:
+    # SecretConfig is not a dataclass, compare the attributes
+    return getattr(old, "__dict__", old) != getattr(new, "__dict__", new)
+
+
+def reload(config_filename: str) -> list[str]:
+    """Read the configuration again, return the names of the changed
+    sections. The current configuration is kept if the file is invalid
+    (ValueError), and the sections of RESTART keep their current values"""
+    sections = load(config_filename)
+
+    changed = []
+    for name, section in sections.items():
+        if not _differs(globals()[name], section):
+            continue
+        if name in RESTART:
+            logger.warning(f"changes of [{name}] need a restart")
+            continue
+        globals()[name] = section
+        changed.append(name)
+    return changed
 
 
 if __name__ == "__main__":
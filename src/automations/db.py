@@ -1,12 +1,61 @@
 import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import lru_cache
 import logging
+from time import monotonic
+from time import perf_counter
+from time import time
 
 import aiosqlite
 from sqlite3 import Error as Sqlite3Error
+from sqlite3 import OperationalError
 
 import automations.config as config
+import automations.metrics as metrics
+import automations.rollup as rollup
+import automations.spool as spool
+import automations.supervisor as supervisor
 
+
+@dataclass
+class WriteStats:
+    queue_depth: int = 0
+    flushes: int = 0
+    rows_flushed: int = 0
+    rows_dropped: int = 0
+    rows_spooled: int = 0
+    last_flush_latency: float = 0.0
+    max_flush_latency: float = 0.0
+
+
+_INSERTS = metrics.counter("automations_db_inserts_total", "Rows inserted", ("table",))
+_DROPPED = metrics.counter("automations_db_dropped_total", "Buffered rows lost")
+_SPOOLED = metrics.counter(
+    "automations_db_spooled_total", "Rows spooled while the database was unavailable"
+)
+_FLUSH_LATENCY = metrics.histogram(
+    "automations_db_flush_seconds", "Duration of the write-behind flushes"
+)
+metrics.gauge(
+    "automations_db_queue_depth", "Rows waiting in the write-behind buffer",
+    func=lambda: stats.queue_depth
+)
+
+_buffer = {}  # type: ignore[var-annotated]
+_buffer_since = None
+# samples aggregated in the rollups, stored or not
+_samples = {}  # type: ignore[var-annotated]
 _conn = None
+_connect_after = 0.0
+# the flushes run in an explicit transaction on the writer connection: the
+# other statements of the writer wait for them, so that a rolled back flush
+# does not undo them
+_flush_lock = asyncio.Lock()
+_pending = asyncio.Event()
+_readers: list = []
+_readers_queue = asyncio.Queue()  # type: ignore[var-annotated]
+stats = WriteStats()
 
 # logger initial setup
 logger = logging.getLogger(__name__)
@@ -37,6 +86,18 @@ async def create_tables():
         ");"
     )
 
+    await _conn.execute(
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        "    id INTEGER PRIMARY KEY,"
+        "    kind VARCHAR(10),"
+        "    key VARCHAR(30),"
+        "    subject TEXT,"
+        "    content TEXT,"
+        "    count INTEGER DEFAULT 1,"
+        "    timestamp TIMESTAMP(1) DEFAULT (STRFTIME('%s', 'NOW'))"
+        ");"
+    )
+
     await _conn.execute(
         "CREATE TABLE IF NOT EXISTS pressure ("
         "    pressure REAL,"
@@ -54,30 +115,424 @@ async def create_tables():
     )
 
 
-async def init():
+# each migration is a list of statements run in a single transaction (except
+# for migrations containing a VACUUM, which cannot run in a transaction), the
+# database version is kept in user_version
+_MIGRATIONS = (
+    # 1: time indexes and rollup tables
+    (
+        "CREATE INDEX IF NOT EXISTS linky_timestamp ON linky(timestamp)",
+        "CREATE INDEX IF NOT EXISTS linky_snapshot_timestamp ON linky_snapshot(timestamp)",
+        "CREATE INDEX IF NOT EXISTS on_off_timestamp ON on_off(timestamp)",
+        "CREATE INDEX IF NOT EXISTS on_off_device ON on_off(device, timestamp)",
+        "CREATE INDEX IF NOT EXISTS pressure_timestamp ON pressure(timestamp)",
+        "CREATE INDEX IF NOT EXISTS temperature_humidity_timestamp "
+        "ON temperature_humidity(timestamp)",
+        "CREATE INDEX IF NOT EXISTS temperature_humidity_device "
+        "ON temperature_humidity(device, timestamp)",
+        "CREATE TABLE IF NOT EXISTS rollup ("
+        "    series VARCHAR(60),"
+        "    resolution INTEGER,"
+        "    bucket INTEGER,"
+        "    count INTEGER,"
+        "    min REAL,"
+        "    max REAL,"
+        "    sum REAL,"
+        "    first REAL,"
+        "    last REAL,"
+        "    PRIMARY KEY (series, resolution, bucket)"
+        ") WITHOUT ROWID",
+        "CREATE VIEW IF NOT EXISTS energy AS"
+        "    SELECT resolution, bucket,"
+        "        last - LAG(last) OVER (PARTITION BY resolution ORDER BY bucket) AS energy"
+        "    FROM rollup WHERE series = 'linky.east'",
+    ),
+    # 2: allow the retention to release free pages by small steps (the
+    # VACUUM is needed only once, to change the auto_vacuum mode)
+    (
+        "PRAGMA auto_vacuum = INCREMENTAL",
+        "VACUUM",
+    ),
+    # 3: rows tagged with the domio hub they come from, energy of each meter
+    (
+        "ALTER TABLE linky ADD COLUMN source VARCHAR(30)",
+        "ALTER TABLE linky_snapshot ADD COLUMN source VARCHAR(30)",
+        "ALTER TABLE pressure ADD COLUMN source VARCHAR(30)",
+        "ALTER TABLE temperature_humidity ADD COLUMN source VARCHAR(30)",
+        "DROP VIEW IF EXISTS energy",
+        "CREATE VIEW energy AS"
+        "    SELECT series, resolution, bucket,"
+        "        last - LAG(last) OVER ("
+        "            PARTITION BY series, resolution ORDER BY bucket"
+        "        ) AS energy"
+        "    FROM rollup WHERE series = 'linky.east' OR series GLOB 'linky.*.east'",
+    ),
+    # 4: aggregates of the closed days and months, computed by the reports
+    (
+        "CREATE TABLE IF NOT EXISTS report ("
+        "    period VARCHAR(10),"
+        "    key VARCHAR(60),"
+        "    value REAL,"
+        "    PRIMARY KEY (period, key)"
+        ") WITHOUT ROWID",
+    ),
+)
+
+
+async def migrate():
+    async with _conn.execute("PRAGMA user_version") as cursor:
+        (version,) = await cursor.fetchone()
+
+    for number, statements in enumerate(_MIGRATIONS[version:], start=version + 1):
+        logger.info(f"migrating database to version {number}")
+        if any(statement.startswith("VACUUM") for statement in statements):
+            for statement in statements:
+                await _conn.execute(statement)
+            await _conn.execute(f"PRAGMA user_version = {number}")
+            continue
+
+        await _conn.execute("BEGIN")
+        try:
+            for statement in statements:
+                await _conn.execute(statement)
+            await _conn.execute(f"PRAGMA user_version = {number}")
+        except Sqlite3Error:
+            await _conn.execute("ROLLBACK")
+            raise
+        await _conn.execute("COMMIT")
+
+
+async def _configure(conn):
+    await conn.execute(f"PRAGMA busy_timeout = {int(config.database.busy_timeout)}")
+    await conn.execute(f"PRAGMA cache_size = {int(config.database.cache_size)}")
+    await conn.execute(f"PRAGMA mmap_size = {int(config.database.mmap_size)}")
+
+
+async def _connect() -> bool:
+    """Open the writer connection, at most once per retry interval"""
     global _conn
+    global _connect_after
+
+    if monotonic() < _connect_after:
+        return False
+    _connect_after = monotonic() + config.spool.retry_interval
 
     try:
         _conn = await aiosqlite.connect(config.database.path, autocommit=True)
+        await _configure(_conn)
+        await _conn.execute(f"PRAGMA journal_mode = {config.database.journal_mode}")
+        await _conn.execute(f"PRAGMA synchronous = {config.database.synchronous}")
         await create_tables()
+        await migrate()
     except Sqlite3Error as exc:
         logger.error(f"error while creating tables ({exc})")
+        if _conn is not None:
+            await _conn.close()
+            _conn = None
+        return False
 
+    return True
 
-async def execute_query(query: str, *args):
-    if _conn is not None:
+
+async def init():
+    # rows that could not be written before the last stop are replayed with
+    # the next flush
+    spool.init()
+
+    await _connect()
+
+    # read-only connections, so that queries do not wait behind the writes
+    # (in WAL mode, readers and the writer do not block each other)
+    try:
+        for _ in range(config.database.readers - len(_readers)):
+            reader = await aiosqlite.connect(
+                f"file:{config.database.path}?mode=ro", uri=True, autocommit=True
+            )
+            await _configure(reader)
+            _readers.append(reader)
+            _readers_queue.put_nowait(reader)
+    except Sqlite3Error as exc:
+        logger.error(f"error while opening reader connections ({exc})")
+
+    supervisor.start("db-flush", _flush_task)
+
+
+async def execute_query(query: str, *args) -> int | None:
+    """Execute a query immediately, bypassing the write-behind buffer.
+    Return the rowid of the last inserted row"""
+    async with _flush_lock:
+        if _conn is not None:
+            try:
+                cursor = await _conn.execute(query, args)
+                return cursor.lastrowid
+            except Sqlite3Error as exc:
+                logger.error(f"error while executing query ({exc})")
+    return None
+
+
+async def execute_count(query: str, *args) -> int:
+    """Execute a query immediately and return the number of modified rows"""
+    async with _flush_lock:
+        if _conn is not None:
+            try:
+                cursor = await _conn.execute(query, args)
+                return cursor.rowcount
+            except Sqlite3Error as exc:
+                logger.error(f"error while executing query ({exc})")
+    return 0
+
+
+async def incremental_vacuum(pages: int) -> int:
+    """Release at most `pages` free pages, return the number of free pages
+    left"""
+    async with _flush_lock:
+        if _conn is not None:
+            try:
+                # the pragma releases one page per step, fetch all the rows
+                async with _conn.execute(f"PRAGMA incremental_vacuum({int(pages)})") as cursor:
+                    await cursor.fetchall()
+                async with _conn.execute("PRAGMA freelist_count") as cursor:
+                    (count,) = await cursor.fetchone()
+                return count
+            except Sqlite3Error as exc:
+                logger.error(f"error while releasing free pages ({exc})")
+    return 0
+
+
+@asynccontextmanager
+async def _reader():
+    if not _readers:
+        # no reader connection available, fallback to the writer
+        yield _conn
+        return
+
+    conn = await _readers_queue.get()
+    try:
+        yield conn
+    finally:
+        _readers_queue.put_nowait(conn)
+
+
+async def fetch_all(query: str, *args) -> list:
+    """Execute a read query on one of the read-only connections"""
+    async with _reader() as conn:
+        if conn is not None:
+            try:
+                async with conn.execute(query, args) as cursor:
+                    return await cursor.fetchall()
+            except Sqlite3Error as exc:
+                logger.error(f"error while executing query ({exc})")
+    return []
+
+
+async def iterate(
+    table: str, names: list[str], where: str, *args, order: tuple = ("rowid",),
+    size: int = 500
+):
+    """Yield the `names` columns of the rows of `table` matching `where`, in
+    `order`, by batches of `size`, so that large results are never loaded at
+    once. Each batch is read by its own query resuming after the last row
+    (keyset pagination): no connection nor read transaction is held while the
+    consumer handles a batch, however slow it is. The `order` columns must
+    identify the rows"""
+    keys = ", ".join(order)
+    select = f"SELECT {keys}, {', '.join(names)} FROM {table} WHERE"
+    first = f"{select} {where} ORDER BY {keys} LIMIT ?"
+    # the bound on the first key lets SQLite seek its index to the last row,
+    # the row value comparison alone would be checked on the rows before it.
+    # It comes first: SQLite seeks with the first bound of a column
+    after = (
+        f"{select} {order[0]} >= ? AND ({where}) "
+        f"AND ({keys}) > ({', '.join('?' * len(order))}) ORDER BY {keys} LIMIT ?"
+    )
+    last: tuple = ()
+    while True:
+        if last:
+            rows = await fetch_all(after, last[0], *args, *last, size)
+        else:
+            rows = await fetch_all(first, *args, size)
+        if not rows:
+            return
+        last = rows[-1][:len(order)]
+        yield [row[len(order):] for row in rows]
+        if len(rows) < size:
+            return
+
+
+@lru_cache(maxsize=64)
+def _insert_query(table: str, columns: tuple) -> str:
+    return (
+        f"INSERT INTO {table}({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' * len(columns))})"
+    )
+
+
+async def insert(table: str, /, store: bool = True, aggregate: bool = True, **values):
+    """Queue a row in the write-behind buffer. The row timestamp is taken now
+    so that it does not depend on when the buffer is flushed. A row can be
+    only stored, or only aggregated in the rollups (a sample skipped by the
+    deadband)"""
+    global _buffer_since
+
+    values.setdefault("timestamp", int(time()))
+    key = (table, tuple(values))
+    row = tuple(values.values())
+    if aggregate and table in rollup.SERIES:
+        _samples.setdefault(key, []).append(row)
+    if store:
+        _buffer.setdefault(key, []).append(row)
+        stats.queue_depth += 1
+
+    if _buffer_since is None:
+        _buffer_since = monotonic()
+        _pending.set()
+
+    if stats.queue_depth >= config.database.batch_size:
+        await flush()
+
+
+async def _write(buffer: dict):
+    """Write a buffer in a single transaction, the aggregates of the samples
+    being the rows of its rollup table"""
+    await _conn.execute("BEGIN")
+    try:
+        for (table, columns), rows in buffer.items():
+            if table == "rollup":
+                await _conn.executemany(rollup.UPSERT, rows)
+            else:
+                await _conn.executemany(_insert_query(table, columns), rows)
+        await _conn.execute("COMMIT")
+    except Sqlite3Error:
+        try:
+            await _conn.execute("ROLLBACK")
+        except Sqlite3Error:
+            # no transaction active
+            pass
+        raise
+
+
+def _drop(count: int):
+    stats.rows_dropped += count
+    _DROPPED.inc(amount=count)
+
+
+def _count(buffer: dict) -> int:
+    """Number of rows of a buffer, not counting its rollup aggregates"""
+    return sum(len(rows) for (table, _), rows in buffer.items() if table != "rollup")
+
+
+def _spool(buffer: dict, depth: int):
+    # the aggregates are spooled after the rows, they are not rows lost
+    aggregates = buffer.pop(("rollup", rollup.COLUMNS), None)
+    lost = spool.append(buffer)
+    if aggregates:
+        spool.append({("rollup", rollup.COLUMNS): aggregates})
+    stats.rows_spooled += depth - lost
+    _SPOOLED.inc(amount=depth - lost)
+    if lost:
+        _drop(lost)
+
+
+async def _replay():
+    buffer = spool.read()
+    count = _count(buffer)
+    try:
+        await _write(buffer)
+    except OperationalError:
+        # still unavailable
+        raise
+    except Sqlite3Error as exc:
+        # the rows would never be written, do not block the spool with them
+        logger.error(f"error while replaying {count} spooled rows ({exc}), dropping them")
+        _drop(count)
+    else:
+        logger.info(f"{count} spooled rows replayed")
+    spool.clear()
+
+
+async def flush():
+    """Write all the buffered rows in a single transaction. When the database
+    is unavailable or locked, the rows are spooled and written later"""
+    global _buffer
+    global _buffer_since
+    global _samples
+
+    async with _flush_lock:
+        if not _buffer and not _samples:
+            return
+
+        buffer = _buffer
+        depth = stats.queue_depth
+        if _samples:
+            # pre-aggregated, so that each bucket is written once per flush,
+            # and spooled with the rows
+            buffer[("rollup", rollup.COLUMNS)] = rollup.aggregate(_samples)
+        _buffer = {}
+        _samples = {}
+        _buffer_since = None
+        _pending.clear()
+        stats.queue_depth = 0
+
+        if _conn is None and not await _connect():
+            _spool(buffer, depth)
+            return
+
+        start = perf_counter()
         try:
-            await _conn.execute(query, args)
+            if spool.pending():
+                await _replay()
+            await _write(buffer)
+        except OperationalError as exc:
+            logger.error(f"error while flushing {depth} rows ({exc}), spooling them")
+            _spool(buffer, depth)
+            return
         except Sqlite3Error as exc:
-            logger.error(f"error while executing query ({exc})")
+            logger.error(f"error while flushing {depth} rows ({exc})")
+            _drop(depth)
+            return
+
+        latency = perf_counter() - start
+        stats.flushes += 1
+        stats.rows_flushed += depth
+        stats.last_flush_latency = latency
+        stats.max_flush_latency = max(stats.max_flush_latency, latency)
+        _FLUSH_LATENCY.observe(latency)
+        for (table, _), rows in buffer.items():
+            if table != "rollup":
+                _INSERTS.inc(table, amount=len(rows))
+
+
+async def _flush_task():
+    try:
+        while True:
+            await _pending.wait()
+            if _buffer_since is not None:
+                delay = _buffer_since + config.database.batch_max_age - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await flush()
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        pass
 
 
 async def close():
     global _conn
+    global _connect_after
+
+    await supervisor.stop("db-flush")
+    await flush()
+
+    while _readers:
+        await _readers.pop().close()
+    while not _readers_queue.empty():
+        _readers_queue.get_nowait()
 
     if _conn is not None:
         await _conn.close()
         _conn = None
+    _connect_after = 0.0
+
+    spool.close()
 
 
 async def run(config_filename: str):
@@ -86,21 +541,11 @@ async def run(config_filename: str):
     await init()
 
     try:
-        await execute_query(
-            "INSERT INTO on_off(device, state) VALUES (?, ?)", "doorbell", True
-        )
-
-        await execute_query(
-            "INSERT INTO linky(east, sinst) VALUES (?, ?)", 1000, 2000
-        )
-
-        await execute_query(
-            "INSERT INTO pressure(pressure) VALUES (?)", 1013.25
-        )
-
-        await execute_query(
-            "INSERT INTO temperature_humidity(device, humidity, temperature) VALUES (?, ?, ?)",
-            "sejour", 50.0, 21.0
+        await insert("on_off", device="doorbell", state=True)
+        await insert("linky", east=1000, sinst=2000)
+        await insert("pressure", pressure=1013.25)
+        await insert(
+            "temperature_humidity", device="sejour", humidity=50.0, temperature=21.0
         )
     finally:
         await close()
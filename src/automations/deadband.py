@@ -0,0 +1,88 @@
+from time import time
+
+import automations.config as config
+from automations.rollup import series_name
+
+
+class _Series:
+    __slots__ = ("skipped", "stored", "stored_time")
+
+    def __init__(self, row: dict):
+        self.stored = row
+        self.stored_time = row["timestamp"]
+        self.skipped = None
+
+
+# (table, source, device) -> series state
+_series: dict[tuple, _Series] = {}
+
+
+def _threshold(table: str, column: str, device: str | None) -> float:
+    thresholds = config.deadband.thresholds
+    if device is not None:
+        threshold = thresholds.get(series_name(table, column, device))
+        if threshold is not None:
+            return threshold
+    return thresholds.get(series_name(table, column), 0)
+
+
+def _heartbeat(table: str, device: str | None) -> float:
+    heartbeats = config.deadband.heartbeats
+    if device is not None:
+        heartbeat = heartbeats.get(f"{table}.{device}")
+        if heartbeat is not None:
+            return heartbeat
+    return heartbeats.get(table, config.deadband.heartbeat)
+
+
+def _changed(table: str, device: str | None, stored: dict, row: dict) -> bool:
+    for column, value in row.items():
+        if column in ("device", "source", "timestamp"):
+            continue
+        previous = stored.get(column)
+        if value is None or previous is None or isinstance(value, bool):
+            if value != previous:
+                return True
+        elif abs(value - previous) > _threshold(table, column, device):
+            return True
+    return False
+
+
+def process(table: str, **values) -> list[dict]:
+    """Return the rows to store for a new sample: none while the sample stays
+    in the deadband of the last stored one, otherwise the sample itself,
+    preceded by the last skipped sample so that the time of the change is
+    known. With null thresholds, the stored rows rebuild the sampled step
+    series exactly"""
+    values.setdefault("timestamp", int(time()))
+    device = values.get("device")
+    key = (table, values.get("source"), device)
+
+    series = _series.get(key)
+    if series is None:
+        _series[key] = _Series(values)
+        return [values]
+
+    changed = _changed(table, device, series.stored, values)
+    if not changed and values["timestamp"] - series.stored_time < _heartbeat(table, device):
+        series.skipped = values
+        return []
+
+    rows = [values]
+    if changed and series.skipped is not None:
+        rows.insert(0, series.skipped)
+    series.stored = values
+    series.stored_time = values["timestamp"]
+    series.skipped = None
+    return rows
+
+
+def flush() -> list[tuple[str, dict]]:
+    """Return the (table, row) skipped samples which were not stored yet, to
+    keep the tail of the series exact when stopping"""
+    rows = []
+    for (table, _, _), series in _series.items():
+        if series.skipped is not None:
+            rows.append((table, series.skipped))
+            series.skipped = None
+    return rows
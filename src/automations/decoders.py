@@ -0,0 +1,91 @@
+# Decoding of the zigbee2mqtt payloads into typed records, one class per
+# device model. The payloads are parsed from bytes, without an intermediate
+# str with orjson when it is installed (pip install automations[fast]), and
+# the malformed ones are counted by the automations_decode_errors_total
+# metric instead of being logged
+
+import json
+from operator import itemgetter
+
+import automations.metrics as metrics
+
+
+try:
+    from orjson import loads as _loads
+    BACKEND = "orjson"
+except ImportError:
+    _loads = json.loads
+    BACKEND = "json"
+
+_ERRORS = metrics.counter(
+    "automations_decode_errors_total", "Malformed zigbee2mqtt payloads", ("model", "error")
+)
+
+
+class Snzb02p:
+    """Sonoff SNZB-02P temperature and humidity sensor"""
+
+    __slots__ = ("temperature", "humidity", "battery", "linkquality")
+
+    REQUIRED = ("temperature", "humidity")
+
+    def __init__(
+        self, temperature: float, humidity: float, battery: float | None = None,
+        linkquality: int | None = None
+    ):
+        self.temperature = temperature
+        self.humidity = humidity
+        self.battery = battery
+        self.linkquality = linkquality
+
+
+MODELS = {
+    "snzb02p": Snzb02p,
+}
+
+# fields of the records, in a single C call when they are all present
+_GETTERS = {model: itemgetter(*cls.__slots__) for model, cls in MODELS.items()}
+
+
+def loads(payload: bytes):
+    """Parse a JSON payload with the fastest backend, raise ValueError if it
+    is malformed"""
+    return _loads(payload)
+
+
+_NUMBERS = {int, float}
+
+
+def decode(model: str, payload: bytes | None):
+    """Return the record of a `model` device payload, or None if the payload
+    is malformed: not JSON, or with a missing or non numeric field"""
+    cls = MODELS[model]
+    if not payload:
+        _ERRORS.inc(model, "empty")
+        return None
+
+    try:
+        data = _loads(payload)
+    except ValueError:
+        _ERRORS.inc(model, "json")
+        return None
+    if type(data) is not dict:
+        _ERRORS.inc(model, "schema")
+        return None
+
+    try:
+        values = _GETTERS[model](data)
+    except KeyError:
+        values = tuple(map(data.get, cls.__slots__))
+    if not _NUMBERS.issuperset(map(type, values)):
+        # missing optional fields, or a malformed payload
+        for name, value in zip(cls.__slots__, values):
+            if value is None:
+                if name in cls.REQUIRED:
+                    _ERRORS.inc(model, "missing")
+                    return None
+            elif type(value) not in _NUMBERS:
+                _ERRORS.inc(model, "type")
+                return None
+
+    return cls(*values)
@@ -0,0 +1,165 @@
+import asyncio
+from collections import Counter
+from collections import deque
+import logging
+import os
+from pathlib import Path
+import sys
+import threading
+from time import perf_counter
+from time import strftime
+
+import automations.config as config
+
+# functions where the event loop thread waits for events
+_IDLE_FUNCTIONS = {"select", "poll", "epoll", "kqueue", "control"}
+
+_last_tick = 0.0
+_lock = threading.Lock()
+_loop = None
+_loop_thread_id = None
+_samples: Counter = Counter()
+_stalls: deque = deque(maxlen=100)
+_stop = threading.Event()
+_task_samples: Counter = Counter()
+_thread = None
+_tick_handle = None
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _tick():
+    global _last_tick
+    global _tick_handle
+
+    _last_tick = perf_counter()
+    _tick_handle = _loop.call_later(config.diagnostics.tick_interval, _tick)
+
+
+def _fold(frame) -> list[str]:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _current_task_name() -> str:
+    try:
+        task = asyncio.current_task(_loop)
+    except RuntimeError:
+        task = None
+    return task.get_name() if task is not None else "<callback>"
+
+
+def _sampler():
+    """Sample the event loop thread stack and detect stalls of the loop"""
+    interval = config.diagnostics.sample_interval
+    threshold = config.diagnostics.slow_threshold
+    stall = None
+
+    while not _stop.wait(interval):
+        frame = sys._current_frames().get(_loop_thread_id)
+        if frame is None:
+            continue
+
+        stack = _fold(frame)
+        idle = frame.f_code.co_name in _IDLE_FUNCTIONS
+        task = "<idle>" if idle else _current_task_name()
+        with _lock:
+            _samples[";".join([task] + stack)] += 1
+            _task_samples[task] += 1
+
+        late = perf_counter() - _last_tick - config.diagnostics.tick_interval
+        if late > threshold:
+            if stall is None:
+                # first sample of the stall: keep the blocking stack
+                stall = [late, task, stack]
+            else:
+                stall[0] = late
+        elif stall is not None:
+            _stalls.append(tuple(stall))
+            logger.warning(
+                f"event loop blocked {stall[0] * 1000:.0f} ms by {stall[1]} "
+                f"in {' < '.join(reversed(stall[2][-5:]))}"
+            )
+            stall = None
+
+
+def start():
+    global _loop
+    global _loop_thread_id
+    global _thread
+
+    if _thread is not None:
+        return
+
+    _loop = asyncio.get_running_loop()
+    _loop_thread_id = threading.get_ident()
+    _stop.clear()
+    _tick()
+    _thread = threading.Thread(target=_sampler, name="diagnostics", daemon=True)
+    _thread.start()
+    logger.info("diagnostics started")
+
+
+def dump() -> Path:
+    """Write the collected samples as collapsed stacks (flamegraph.pl and
+    speedscope format) and a report of the loop stalls and of the time spent
+    per task"""
+    with _lock:
+        samples = dict(_samples)
+        task_samples = dict(_task_samples)
+    stalls = list(_stalls)
+
+    output_dir = Path(config.diagnostics.output_dir).expanduser()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    prefix = output_dir / f"automations-{strftime('%Y%m%d-%H%M%S')}"
+
+    with open(f"{prefix}.folded", "w") as f:
+        for stack, count in samples.items():
+            f.write(f"{stack} {count}\n")
+
+    interval = config.diagnostics.sample_interval
+    total = sum(task_samples.values()) or 1
+    with open(f"{prefix}.txt", "w") as f:
+        f.write("time per task (sampled)\n")
+        for task, count in sorted(task_samples.items(), key=lambda i: -i[1]):
+            f.write(f"  {task:<30} {count * interval:10.2f} s {100 * count / total:6.1f} %\n")
+        f.write("\nslowest event loop stalls\n")
+        for late, task, stack in sorted(stalls, reverse=True):
+            f.write(f"  {late * 1000:8.0f} ms  {task}\n")
+            for frame in reversed(stack[-10:]):
+                f.write(f"              {frame}\n")
+
+    logger.info(f"diagnostics dumped to {prefix}.folded and {prefix}.txt")
+    return prefix
+
+
+def on_signal():
+    """SIGUSR1 handler: start the diagnostics if they are not running, dump
+    them otherwise"""
+    if _thread is None:
+        start()
+    else:
+        dump()
+
+
+def stop():
+    global _thread
+    global _tick_handle
+
+    if _thread is None:
+        return
+
+    _stop.set()
+    _thread.join()
+    _thread = None
+
+    if _tick_handle is not None:
+        _tick_handle.cancel()
+        _tick_handle = None
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from random import uniform
+from time import perf_counter
+
+import automations.config as config
+import automations.metrics as metrics
+from automations.typem import HubConfig
+
+_REQUESTS = metrics.counter(
+    "automations_domio_requests_total", "Requests to domio", ("hub", "path", "status")
+)
+_DURATION = metrics.histogram(
+    "automations_domio_request_seconds", "Duration of the requests to domio",
+    ("hub", "path", "outcome")
+)
+
+_semaphore = None
+_session = None
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def init():
+    global _semaphore
+    global _session
+
+    # aiohttp is the slowest import of the daemon, it is only loaded when a
+    # command needs domio
+    import aiohttp
+
+    if _session is None:
+        # the pool is shared by the hubs, each of them having at most
+        # pool_size connections
+        connector = aiohttp.TCPConnector(
+            limit=config.domio.pool_size * len(config.domio.hubs),
+            limit_per_host=config.domio.pool_size, ttl_dns_cache=300
+        )
+        timeout = aiohttp.ClientTimeout(total=config.domio.timeout)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _semaphore = asyncio.Semaphore(config.domio.concurrency)
+
+
+async def get(path: str, hub: HubConfig | None = None) -> dict | None:
+    """Return the data part of the answer of a hub (the first one by
+    default), or None if it failed to answer after all the retries"""
+    import aiohttp
+
+    if hub is None:
+        hub = config.domio.hubs[0]
+    url = f"http://{hub.hostname}:{hub.port}{path}"
+    timeout = None
+    if hub.timeout is not None:
+        timeout = aiohttp.ClientTimeout(total=hub.timeout)
+
+    for attempt in range(config.domio.retries + 1):
+        if attempt > 0:
+            # exponential backoff with jitter
+            delay = config.domio.backoff * 2 ** (attempt - 1)
+            await asyncio.sleep(uniform(delay / 2, delay))
+
+        # every attempt is timed, the failed ones being the slowest
+        start = perf_counter()
+        outcome = "error"
+        try:
+            async with _session.get(url, timeout=timeout) as resp:
+                _REQUESTS.inc(hub.name, path, resp.status)
+                if resp.status == 200:
+                    try:
+                        data = (await resp.json())["data"]
+                    except (KeyError, TypeError, ValueError) as exc:
+                        # a malformed answer fails this hub only, not the
+                        # whole polling round
+                        logger.warning(f"bad answer of hub '{hub.name}' for {url} ({exc!r})")
+                        return None
+                    outcome = "ok"
+                    return data
+
+                outcome = "status"
+                logger.debug(f"bad status ({resp.status}) when getting {url}")
+                if resp.status < 500:
+                    # no need to retry a client error
+                    return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            if isinstance(exc, asyncio.TimeoutError):
+                outcome = "timeout"
+            _REQUESTS.inc(hub.name, path, "error")
+            logger.debug(f"error when getting {url} ({exc!r})")
+        finally:
+            _DURATION.observe(perf_counter() - start, hub.name, path, outcome)
+
+    logger.warning(f"unable to get {url} from domio")
+    return None
+
+
+async def _get_bounded(path: str, hub: HubConfig) -> tuple[HubConfig, dict | None]:
+    async with _semaphore:
+        return hub, await get(path, hub)
+
+
+async def gather(path: str, tag: str):
+    """Get `path` from the hubs having the sensor `tag`, at most concurrency
+    hubs at a time, and yield the (hub, data) answers as they arrive, so
+    that a slow hub does not delay the others"""
+    hubs = [hub for hub in config.domio.hubs if tag in hub.tags]
+    if len(hubs) == 1:
+        data = await get(path, hubs[0])
+        if data is not None:
+            yield hubs[0], data
+        return
+
+    pending = [asyncio.create_task(_get_bounded(path, hub)) for hub in hubs]
+    try:
+        for next_answer in asyncio.as_completed(pending):
+            hub, data = await next_answer
+            if data is not None:
+                yield hub, data
+    finally:
+        # the poll was cancelled, or the consumer stopped early
+        for task in pending:
+            task.cancel()
+
+
+async def close():
+    global _semaphore
+    global _session
+
+    if _session is not None:
+        await _session.close()
+        _session = None
+        _semaphore = None
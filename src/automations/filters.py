@@ -0,0 +1,210 @@
+from bisect import bisect_left
+from bisect import insort
+from collections import deque
+from math import sqrt
+from operator import gt
+from operator import lt
+from typing import Callable
+
+
+class Ewma:
+    """Exponentially weighted moving average"""
+
+    __slots__ = ("alpha", "value")
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, v: float) -> float:
+        if self.value is None:
+            self.value = v
+        else:
+            self.value += self.alpha * (v - self.value)
+        return self.value
+
+
+class _RollingExtremum:
+    """Extremum of the last `size` values, using a monotonic deque: amortized
+    O(1) per update. `dominates(a, b)` is true when `a` is kept over `b`"""
+
+    __slots__ = ("dominates", "size", "_count", "_deque")
+
+    def __init__(self, size: int, dominates: Callable[[float, float], bool]):
+        self.size = size
+        self.dominates = dominates
+        self._count = 0
+        self._deque = deque()  # type: ignore[var-annotated]  # (index, value)
+
+    def update(self, v: float) -> float:
+        d = self._deque
+        dominates = self.dominates
+        while d and not dominates(d[-1][1], v):
+            d.pop()
+        d.append((self._count, v))
+        if d[0][0] <= self._count - self.size:
+            d.popleft()
+        self._count += 1
+        return d[0][1]
+
+    @property
+    def value(self):
+        return self._deque[0][1] if self._deque else None
+
+
+class RollingMin(_RollingExtremum):
+    """Minimum of the last `size` values"""
+
+    __slots__ = ()
+
+    def __init__(self, size: int):
+        super().__init__(size, lt)
+
+
+class RollingMax(_RollingExtremum):
+    """Maximum of the last `size` values"""
+
+    __slots__ = ()
+
+    def __init__(self, size: int):
+        super().__init__(size, gt)
+
+
+class RollingMedian:
+    """Median of the last `size` values. The window is kept sorted: O(log n)
+    search and a memmove of at most `size` pointers per update"""
+
+    __slots__ = ("size", "_sorted", "_values")
+
+    def __init__(self, size: int):
+        self.size = size
+        self._sorted = []  # type: ignore[var-annotated]
+        self._values = deque()  # type: ignore[var-annotated]
+
+    def update(self, v: float) -> float:
+        if len(self._values) == self.size:
+            old = self._values.popleft()
+            del self._sorted[bisect_left(self._sorted, old)]
+        self._values.append(v)
+        insort(self._sorted, v)
+        return self.value
+
+    @property
+    def value(self):
+        n = len(self._sorted)
+        if n == 0:
+            return None
+        if n % 2:
+            return self._sorted[n // 2]
+        return (self._sorted[n // 2 - 1] + self._sorted[n // 2]) / 2
+
+
+class OutlierFilter:
+    """Reject values too far from an exponentially weighted mean: a value is
+    an outlier when its distance to the mean is greater than `threshold`
+    standard deviations and greater than `min_deviation`. Outliers do not
+    update the statistics, but after `max_rejections` consecutive outliers the
+    filter restarts from the new level"""
+
+    __slots__ = (
+        "alpha", "max_rejections", "min_deviation", "rejected", "threshold",
+        "_mean", "_rejections", "_variance"
+    )
+
+    def __init__(
+        self, alpha: float = 0.05, threshold: float = 5.0, min_deviation: float = 0.0,
+        max_rejections: int = 5
+    ):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_deviation = min_deviation
+        self.max_rejections = max_rejections
+        self.rejected = 0
+        self._mean = None
+        self._variance = 0.0
+        self._rejections = 0
+
+    def update(self, v: float) -> float | None:
+        """Return the value if it is accepted, None if it is an outlier"""
+        if self._mean is None or self._rejections >= self.max_rejections:
+            self._mean = v
+            self._variance = 0.0
+            self._rejections = 0
+            return v
+
+        diff = v - self._mean
+        if abs(diff) > max(self.threshold * sqrt(self._variance), self.min_deviation):
+            self._rejections += 1
+            self.rejected += 1
+            return None
+
+        self._rejections = 0
+        incr = self.alpha * diff
+        self._mean += incr
+        self._variance = (1 - self.alpha) * (self._variance + diff * incr)
+        return v
+
+    @property
+    def value(self):
+        return self._mean
+
+
+class TimeWindow:
+    """Mean, maximum and rate of change of the values of the last `window`
+    seconds. Values are aggregated in `buckets` time buckets, so the memory
+    used does not depend on the sample rate (the window moves by steps of one
+    bucket)"""
+
+    __slots__ = ("window", "width", "_buckets", "_last", "_start")
+
+    def __init__(self, window: float, buckets: int = 60):
+        self.window = window
+        self.width = window / buckets
+        # [index, count, total, maximum, first time, first value]
+        self._buckets = [None] * buckets
+        self._last = None  # (time, value)
+        # time of the first value since the window was last empty
+        self._start = None
+
+    def update(self, t: float, v: float):
+        if self._last is None or t - self._last[0] >= self.window:
+            self._start = t
+        index = int(t // self.width)
+        slot = index % len(self._buckets)
+        bucket = self._buckets[slot]
+        if bucket is None or bucket[0] != index:
+            self._buckets[slot] = [index, 1, v, v, t, v]
+        else:
+            bucket[1] += 1
+            bucket[2] += v
+            if v > bucket[3]:
+                bucket[3] = v
+        self._last = (t, v)
+
+    def covered(self) -> bool:
+        """True once the values span the whole window, the aggregates of a
+        window filled for a few seconds are not significant"""
+        return self._last is not None and self._last[0] - self._start >= self.window
+
+    def _live(self) -> list:
+        if self._last is None:
+            return []
+        oldest = int(self._last[0] // self.width) - len(self._buckets)
+        return [b for b in self._buckets if b is not None and b[0] > oldest]
+
+    def mean(self) -> float | None:
+        live = self._live()
+        count = sum(b[1] for b in live)
+        return sum(b[2] for b in live) / count if count else None
+
+    def max(self) -> float | None:
+        return max((b[3] for b in self._live()), default=None)
+
+    def rate(self) -> float | None:
+        """Change per second between the oldest and the last value"""
+        live = self._live()
+        if not live:
+            return None
+        first = min(live)
+        dt = self._last[0] - first[4]
+        return (self._last[1] - first[5]) / dt if dt > 0 else None
@@ -1,12 +1,21 @@
 import argparse
 import asyncio
+from functools import partial
 import importlib
 import logging
+import os
+from pathlib import Path
 import signal
+import subprocess
 import sys
 
+import automations.api as api
 import automations.config as config
 import automations.db as db
+import automations.diag as diag
+import automations.metrics as metrics
+import automations.outbox as outbox
+import automations.scheduler as scheduler
 import automations.tasks as tasks
 
 logger = logging.getLogger()
@@ -16,39 +25,161 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
+_reload_lock = None
+_reload_tasks = set()
+# modification time and size of the watched configuration file
+_config_stamp = None
+
 
 def _set_loggers_level(config_loggers: dict, module_path: list):
     # set log level of modules logger
     for lg_name, lg_config in config_loggers.items():
         if isinstance(lg_config, dict):
-            module_path.append(lg_name)
-            _set_loggers_level(lg_config, module_path)
+            _set_loggers_level(lg_config, module_path + [lg_name])
         elif isinstance(lg_config, str):
             this_module_path = '.'.join(module_path + [lg_name])
-            try:
-                importlib.import_module(this_module_path)
-            except ModuleNotFoundError:
-                logger.warning(f"module {this_module_path} not found")
-                continue
+            if this_module_path.startswith("automations."):
+                # our modules set their level when imported, import them
+                # first. Third-party loggers are configured without importing
+                # the (possibly heavy and lazily loaded) package
+                try:
+                    importlib.import_module(this_module_path)
+                except ModuleNotFoundError:
+                    logger.warning(f"module {this_module_path} not found")
+                    continue
 
             level = getattr(logging, lg_config)
-            if this_module_path in logging.Logger.manager.loggerDict.keys():
-                logging.getLogger(this_module_path).setLevel(level)
+            logging.getLogger(this_module_path).setLevel(level)
         else:
             raise Exception("incorrect type")
 
 
-async def init():
+def _logger_names(config_loggers: dict, module_path: list) -> set[str]:
+    names = set()
+    for lg_name, lg_config in config_loggers.items():
+        if isinstance(lg_config, dict):
+            names |= _logger_names(lg_config, module_path + [lg_name])
+        else:
+            names.add('.'.join(module_path + [lg_name]))
+    return names
+
+
+async def reload(config_filename: str):
+    """Apply the changes of the configuration file without restarting: the
+    connections are kept, only the logger levels and the tasks and schedules
+    of the changed sections are reconfigured"""
+    async with _reload_lock:
+        previous_loggers = config.loggers
+        try:
+            changed = config.reload(config_filename)
+        except (OSError, ValueError) as exc:
+            logger.error(f"configuration not reloaded ({exc})")
+            return
+
+        if not changed:
+            logger.info("configuration unchanged")
+            return
+        logger.info(f"configuration reloaded, changed: {', '.join(changed)}")
+
+        if "loggers" in changed:
+            # loggers no longer configured get back their default level
+            removed = _logger_names(previous_loggers, []) - _logger_names(config.loggers, [])
+            for name in removed:
+                level = logging.INFO if name.startswith("automations.") else logging.NOTSET
+                logging.getLogger(name).setLevel(level)
+            _set_loggers_level(config.loggers, [])
+
+        await tasks.reload(changed)
+
+
+def _on_sighup(config_filename: str):
+    task = asyncio.create_task(reload(config_filename))
+    _reload_tasks.add(task)
+    task.add_done_callback(_reload_tasks.discard)
+
+
+def _stamp(config_filename: str) -> tuple | None:
+    try:
+        stat = os.stat(Path(config_filename).expanduser())
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+async def _watch(config_filename: str):
+    global _config_stamp
+
+    stamp = _stamp(config_filename)
+    if stamp is not None and stamp != _config_stamp:
+        _config_stamp = stamp
+        await reload(config_filename)
+
+
+def import_report(module: str, count: int = 25):
+    """Print the slowest imports of `module`, measured in a new interpreter
+    with -X importtime"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        return
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        try:
+            own, cumulative, name = line.split(":", 1)[1].split("|")
+            imports.append((int(cumulative), int(own), name.rstrip()))
+        except ValueError:
+            continue
+
+    if not imports:
+        # no import measured, or the stderr format changed
+        print(f"{module}: no import time reported")
+        return
+
+    total = max(imports)[0]
+    print(f"{module}: {total / 1000:.1f} ms, {len(imports)} modules")
+    print(f"{'cumulative':>12} {'self':>10}  module")
+    for cumulative, own, name in sorted(imports, reverse=True)[:count]:
+        print(f"{cumulative / 1000:9.1f} ms {own / 1000:7.1f} ms {name}")
+
+
+async def init(diagnostics: bool = False):
     _set_loggers_level(config.loggers, [])
 
+    # diagnostics can also be started at runtime with SIGUSR1
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, diag.on_signal)
+    if diagnostics:
+        diag.start()
+
+    await metrics.init()
     await db.init()
+    await outbox.init()
+    await api.init()
     tasks.init()
 
 
-async def run(config_filename: str):
+async def run(config_filename: str, diagnostics: bool = False, watch: float | None = None):
+    global _config_stamp
+    global _reload_lock
+
     config.read(config_filename)
 
-    await init()
+    await init(diagnostics)
+
+    # the configuration is reloaded with SIGHUP (systemctl reload), or when
+    # the file changes if it is watched
+    _reload_lock = asyncio.Lock()
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGHUP, _on_sighup, config_filename
+    )
+    if watch:
+        _config_stamp = _stamp(config_filename)
+        scheduler.add_interval("config-watch", watch, partial(_watch, config_filename))
 
     while True:
         await asyncio.sleep(60)
@@ -56,7 +187,11 @@ async def run(config_filename: str):
 
 async def close():
     await tasks.close()
+    await api.close()
+    await outbox.close()
     await db.close()
+    await metrics.close()
+    diag.stop()
 
 
 def sigterm_handler(_signo, _stack_frame):
@@ -69,12 +204,28 @@ def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", default="config.toml")
+    parser.add_argument(
+        "--diagnostics", action="store_true",
+        help="report event loop stalls and profile the tasks (dump with SIGUSR1)"
+    )
+    parser.add_argument(
+        "--watch-config", nargs="?", type=float, const=5.0, metavar="SECONDS",
+        help="reload the configuration when its file changes (checked every 5 s by default)"
+    )
+    parser.add_argument(
+        "--import-report", nargs="?", const="automations.main", metavar="MODULE",
+        help="print the slowest imports of the daemon (or of MODULE) and exit"
+    )
     args = parser.parse_args()
 
+    if args.import_report:
+        import_report(args.import_report)
+        return
+
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     try:
-        loop.run_until_complete(run(args.config))
+        loop.run_until_complete(run(args.config, args.diagnostics, args.watch_config))
     except KeyboardInterrupt:
         pass
     finally:
@@ -0,0 +1,235 @@
+import asyncio
+from bisect import bisect_left
+from functools import partial
+import json
+import logging
+from typing import Callable
+
+import automations.config as config
+from automations.utils import done_callback
+
+_DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_health_checks: dict[str, Callable[[], tuple[bool, dict]]] = {}
+_metrics: list = []
+_server = None
+_task_lag = None
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    __slots__ = ("name", "help", "labelnames", "values")
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """Gauge set explicitly, or read from `func` when rendered"""
+
+    __slots__ = ("name", "help", "labelnames", "values", "func")
+
+    def __init__(
+        self, name: str, help: str, labelnames: tuple = (), func: Callable | None = None
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values: dict[tuple, float] = {}
+        self.func = func
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        if self.func is not None:
+            lines.append(f"{self.name} {self.func()}")
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    __slots__ = ("name", "help", "labelnames", "buckets", "values")
+
+    def __init__(
+        self, name: str, help: str, labelnames: tuple = (), buckets: tuple = _DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [count per bucket (non cumulative, +Inf last), sum]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        data[0][bisect_left(self.buckets, value)] += 1
+        data[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = _labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+def counter(name: str, help: str, labelnames: tuple = ()) -> Counter:
+    metric = Counter(name, help, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def gauge(name: str, help: str, labelnames: tuple = (), func: Callable | None = None) -> Gauge:
+    metric = Gauge(name, help, labelnames, func)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(
+    name: str, help: str, labelnames: tuple = (), buckets: tuple = _DEFAULT_BUCKETS
+) -> Histogram:
+    metric = Histogram(name, help, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def add_health_check(name: str, func: Callable[[], tuple[bool, dict]]):
+    """Add a check to the /health endpoint, `func` returns a (healthy,
+    details) tuple"""
+    _health_checks[name] = func
+
+
+def render() -> str:
+    """Return all the metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    lines.append("")
+    return "\n".join(lines)
+
+
+LOOP_LAG = histogram("automations_event_loop_lag_seconds", "Event loop scheduling lag")
+TASK_RESTARTS = counter(
+    "automations_task_restarts_total", "Restarts of long-running tasks", ("task",)
+)
+
+
+async def _lag_task():
+    loop = asyncio.get_running_loop()
+    interval = config.metrics.lag_interval
+
+    try:
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        pass
+
+
+async def _handle(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        path = request.split(b" ", 2)[1].decode()
+        content_type = "text/plain; version=0.0.4; charset=utf-8"
+        if path == "/metrics":
+            status = "200 OK"
+            body = render().encode()
+        elif path == "/health":
+            results = {name: func() for name, func in _health_checks.items()}
+            ok = all(healthy for healthy, _ in results.values())
+            status = "200 OK" if ok else "503 Service Unavailable"
+            content_type = "application/json"
+            body = json.dumps({name: details for name, (_, details) in results.items()}).encode()
+        else:
+            status = "404 Not Found"
+            body = b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (
+        asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError,
+        IndexError, TimeoutError
+    ):
+        pass
+    finally:
+        writer.close()
+
+
+async def init():
+    global _server
+    global _task_lag
+
+    if not config.metrics.enabled:
+        return
+
+    if _server is None:
+        try:
+            _server = await asyncio.start_server(
+                _handle, config.metrics.hostname, config.metrics.port
+            )
+        except OSError as exc:
+            logger.error(f"unable to start metrics server ({exc})")
+
+    if _task_lag is None:
+        _task_lag = asyncio.create_task(_lag_task())
+        _task_lag.add_done_callback(partial(done_callback, logger))
+
+
+async def close():
+    global _server
+    global _task_lag
+
+    if _task_lag is not None:
+        _task_lag.cancel()
+        try:
+            await _task_lag
+        except (asyncio.CancelledError, Exception):
+            # task exceptions are handled by the done callback
+            pass
+        _task_lag = None
+
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
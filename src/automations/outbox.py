@@ -0,0 +1,283 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from dataclasses import field
+from email.message import EmailMessage
+from functools import partial
+import json
+import logging
+from time import perf_counter
+from time import time
+
+import automations.config as config
+import automations.metrics as metrics
+from automations.db import execute_query
+from automations.db import fetch_all
+import automations.supervisor as supervisor
+
+EMAIL = "email"
+MQTT = "mqtt"
+
+
+@dataclass
+class _Notification:
+    kind: str
+    subject: str  # mqtt topic for mqtt notifications
+    content: str  # mqtt payload for mqtt notifications
+    key: str | None = None
+    count: int = 1
+    timestamp: float = field(default_factory=time)
+    id: int | None = None
+    sent: bool = False
+    # the notifications of the same key queued once this one is sent, merged
+    # into a summary held until the end of the coalescing window
+    summary: "_Notification | None" = None
+
+
+_FAILURES = metrics.counter(
+    "automations_notification_failures_total", "Failed notification sends", ("kind",)
+)
+_SENT = metrics.counter("automations_notifications_total", "Notifications sent", ("kind",))
+_SMTP_LATENCY = metrics.histogram("automations_smtp_send_seconds", "Duration of email sends")
+
+# timers releasing the held summaries, by key
+_held: dict[str, asyncio.TimerHandle] = {}
+_mqtt_client = None
+_pending: dict[str, deque] = {EMAIL: deque(), MQTT: deque()}
+_recent: dict[str, _Notification] = {}
+_smtp = None
+_wakeup: dict[str, asyncio.Event] = {EMAIL: asyncio.Event(), MQTT: asyncio.Event()}
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+async def init():
+    # reload the notifications that were not sent before the last stop
+    rows = await fetch_all(
+        "SELECT id, kind, key, subject, content, count, timestamp "
+        "FROM outbox ORDER BY id"
+    )
+    for id_, kind, key, subject, content, count, timestamp in rows:
+        _pending[kind].append(
+            _Notification(kind, subject, content, key, count, timestamp, id_)
+        )
+        _wakeup[kind].set()
+
+    if rows:
+        logger.info(f"{len(rows)} notifications reloaded")
+
+    for kind in (EMAIL, MQTT):
+        supervisor.start(f"outbox-{kind}", partial(_worker, kind))
+
+
+def set_mqtt_client(client):
+    """Set the connected MQTT client used to publish, or None when the
+    connection is lost"""
+    global _mqtt_client
+
+    _mqtt_client = client
+    if client is not None and _pending[MQTT]:
+        _wakeup[MQTT].set()
+
+
+async def _insert(notification: _Notification):
+    notification.id = await execute_query(
+        "INSERT INTO outbox(kind, key, subject, content, count, timestamp) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        notification.kind, notification.key, notification.subject,
+        notification.content, notification.count, int(notification.timestamp)
+    )
+
+
+async def _merge(notification: _Notification):
+    notification.count += 1
+    if notification.id is not None:
+        await execute_query(
+            "UPDATE outbox SET count = ? WHERE id = ?", notification.count, notification.id
+        )
+
+
+def _release(notification: _Notification):
+    _held.pop(notification.key, None)
+    _pending[notification.kind].append(notification)
+    _wakeup[notification.kind].set()
+
+
+async def _enqueue(notification: _Notification):
+    key = notification.key
+    if key is not None:
+        first = _recent.get(key)
+        if (
+            first is not None
+            and notification.timestamp - first.timestamp < config.outbox.coalesce_window
+        ):
+            # a burst: merged into the first notification while it is not
+            # sent, then into a single summary sent when the window closes
+            if not first.sent:
+                await _merge(first)
+            elif first.summary is not None:
+                await _merge(first.summary)
+            elif notification.kind == EMAIL:
+                first.summary = notification
+                await _insert(notification)
+                delay = first.timestamp + config.outbox.coalesce_window - time()
+                _held[key] = asyncio.get_running_loop().call_later(
+                    delay, _release, notification
+                )
+            # MQTT messages of a burst are dropped once the first is published
+            return
+        _recent[key] = notification
+
+    await _insert(notification)
+    _pending[notification.kind].append(notification)
+    _wakeup[notification.kind].set()
+
+
+async def email(subject: str, content: str, key: str | None = None):
+    """Queue an email. Emails with the same `key` queued within the
+    coalescing window of the first one are merged: the first is sent at once,
+    the next ones in a single summary when the window closes"""
+    await _enqueue(_Notification(EMAIL, subject, content, key))
+
+
+async def send_email(subject: str, content: str):
+    """Send an email at once, without the queue, for the commands running
+    outside of the daemon"""
+    try:
+        await _send_email(_Notification(EMAIL, subject, content))
+    finally:
+        await _smtp_close()
+
+
+async def publish(topic: str, payload: dict, key: str | None = None):
+    """Queue a MQTT message, published with the daemon MQTT client. Messages
+    with the same `key` queued within the coalescing window of the first one
+    are published once"""
+    await _enqueue(_Notification(MQTT, topic, json.dumps(payload), key))
+
+
+async def _smtp_connect():
+    global _smtp
+
+    # imported on the first email, most runs never send one
+    import aiosmtplib
+
+    _smtp = aiosmtplib.SMTP(
+        hostname=config.smtp.hostname,
+        port=config.smtp.port,
+        timeout=config.outbox.smtp_timeout
+    )
+    await _smtp.connect()
+    await _smtp.login(config.secret.smtp_username, config.secret.smtp_password)
+
+
+async def _smtp_close():
+    global _smtp
+
+    import aiosmtplib
+
+    if _smtp is not None:
+        try:
+            await _smtp.quit()
+        except aiosmtplib.SMTPException:
+            _smtp.close()
+        _smtp = None
+
+
+async def _send_email(notification: _Notification):
+    import aiosmtplib
+
+    message = EmailMessage()
+    message["From"] = config.secret.mail_from
+    message["To"] = config.secret.mail_to
+    if notification.count > 1:
+        message["Subject"] = f"{notification.subject} (x{notification.count})"
+    else:
+        message["Subject"] = notification.subject
+    message.set_content(notification.content)
+
+    # the session is reused between emails: reconnect once if the server
+    # closed it in the meantime
+    for attempt in range(2):
+        if _smtp is None or not _smtp.is_connected:
+            await _smtp_connect()
+        try:
+            await _smtp.send_message(message)
+            return
+        except aiosmtplib.SMTPServerDisconnected:
+            await _smtp_close()
+            if attempt > 0:
+                raise
+
+
+async def _send(notification: _Notification) -> bool:
+    try:
+        if notification.kind == EMAIL:
+            start = perf_counter()
+            await _send_email(notification)
+            _SMTP_LATENCY.observe(perf_counter() - start)
+        else:
+            if time() - notification.timestamp > config.outbox.mqtt_max_age:
+                logger.info(f"{notification.subject} message expired")
+                return True
+            if _mqtt_client is None:
+                return False
+            await _mqtt_client.publish(notification.subject, payload=notification.content)
+    except Exception as exc:
+        logger.error(f"error while sending {notification.kind} notification ({exc})")
+        _FAILURES.inc(notification.kind)
+        if notification.kind == EMAIL:
+            await _smtp_close()
+        return False
+
+    _SENT.inc(notification.kind)
+    return True
+
+
+async def _worker(kind: str):
+    pending = _pending[kind]
+    wakeup = _wakeup[kind]
+
+    try:
+        while True:
+            if not pending:
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), config.outbox.smtp_idle_timeout)
+                except TimeoutError:
+                    if kind == EMAIL:
+                        # do not keep an idle SMTP session open
+                        await _smtp_close()
+                continue
+
+            notification = pending[0]
+            if await _send(notification):
+                pending.popleft()
+                notification.sent = True
+                if notification.id is not None:
+                    await execute_query("DELETE FROM outbox WHERE id = ?", notification.id)
+            elif kind == MQTT and _mqtt_client is None:
+                # wait for the MQTT connection to come back
+                wakeup.clear()
+                await wakeup.wait()
+            else:
+                await asyncio.sleep(config.outbox.retry_delay)
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        pass
+
+
+async def close():
+    for kind in (EMAIL, MQTT):
+        await supervisor.stop(f"outbox-{kind}")
+
+    await _smtp_close()
+
+    # unsent notifications are kept in the database for the next start
+    for handle in _held.values():
+        handle.cancel()
+    _held.clear()
+    for pending in _pending.values():
+        pending.clear()
+    _recent.clear()
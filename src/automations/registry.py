@@ -0,0 +1,189 @@
+# Last known state of the devices: values, time they were last seen and
+# battery level, fed by the MQTT handlers, the domio pollers and the rows
+# inserted by the rules. Subscribers are notified of the changed values, the
+# devices silent for too long raise an alert, and the registry is snapshotted
+# to a JSON file to be warm at restart
+
+import json
+import logging
+import os
+from pathlib import Path
+from time import time
+from typing import Callable
+
+import automations.config as config
+import automations.metrics as metrics
+import automations.outbox as outbox
+import automations.scheduler as scheduler
+
+
+class Device:
+    __slots__ = ("name", "values", "seen", "battery", "stale")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.values: dict = {}
+        # wall clock time of the last update
+        self.seen = 0.0
+        self.battery = None
+        self.stale = False
+
+    def as_dict(self) -> dict:
+        return {
+            "values": self.values, "seen": self.seen, "battery": self.battery,
+            "stale": self.stale
+        }
+
+
+_devices: dict[str, Device] = {}
+# the devices loaded from the snapshot are not stale before stale_after
+# seconds after the start
+_started = 0.0
+_subscribers: list[Callable[[Device, dict], None]] = []
+
+metrics.gauge(
+    "automations_registry_stale_devices", "Devices silent for too long",
+    func=lambda: sum(d.stale for d in _devices.values())
+)
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _path() -> Path:
+    return Path(config.registry.path or f"{config.database.path}.registry.json").expanduser()
+
+
+def init():
+    """Load the last snapshot and schedule the staleness checks and the
+    snapshots"""
+    global _started
+
+    if not config.registry.enabled:
+        return
+
+    _started = time()
+    try:
+        with open(_path()) as f:
+            for name, state in json.load(f).items():
+                device = Device(name)
+                device.values = state["values"]
+                device.seen = state["seen"]
+                device.battery = state["battery"]
+                device.stale = state["stale"]
+                _devices[name] = device
+        logger.info(f"{len(_devices)} devices loaded from the registry snapshot")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as exc:
+        logger.warning(f"registry snapshot ignored ({exc!r})")
+
+    schedule()
+
+
+def schedule():
+    scheduler.add_interval("registry-check", config.registry.check_interval, _check)
+    scheduler.add_interval("registry-snapshot", config.registry.snapshot_interval, _snapshot)
+
+
+def unschedule():
+    """Stop the staleness checks and the snapshots, when the registry is
+    disabled"""
+    scheduler.remove("registry-check")
+    scheduler.remove("registry-snapshot")
+
+
+def subscribe(func: Callable[[Device, dict], None]):
+    """Call `func(device, changes)` when values of a device change, `changes`
+    mapping the changed names, and the event fields updated, to their new
+    value. `func` runs in the caller of `update` and must not block"""
+    _subscribers.append(func)
+
+
+def unsubscribe(func: Callable[[Device, dict], None]):
+    if func in _subscribers:
+        _subscribers.remove(func)
+
+
+def get(name: str) -> Device | None:
+    return _devices.get(name)
+
+
+def devices() -> dict[str, Device]:
+    return _devices
+
+
+def update(name: str, **values):
+    """Record new values of a device, the None values are ignored"""
+    if not config.registry.enabled:
+        return
+
+    device = _devices.get(name)
+    if device is None:
+        device = _devices[name] = Device(name)
+
+    changes = {}
+    events = config.registry.events
+    for key, value in values.items():
+        if value is not None and (device.values.get(key) != value or key in events):
+            device.values[key] = value
+            changes[key] = value
+    if "battery" in changes:
+        device.battery = changes["battery"]
+
+    device.seen = time()
+    if device.stale:
+        device.stale = False
+        logger.info(f"device {name} is back")
+
+    if changes:
+        for func in _subscribers:
+            try:
+                func(device, changes)
+            except Exception as exc:
+                logger.error(
+                    f"registry subscriber {func!r} failed",
+                    exc_info=(type(exc), exc, exc.__traceback__)
+                )
+
+
+async def _check():
+    """Alert once for each device becoming silent"""
+    now = time()
+    # devices can be added while an alert is queued
+    for device in list(_devices.values()):
+        stale_after = config.registry.stale.get(device.name, config.registry.stale_after)
+        seen = max(device.seen, _started)
+        if device.stale or not stale_after or now - seen <= stale_after:
+            continue
+
+        device.stale = True
+        minutes = (now - device.seen) / 60
+        logger.warning(f"no news of device {device.name} for {minutes:.0f} min")
+        await outbox.email(
+            "Capteur muet !", f"Pas de nouvelles de {device.name} depuis {minutes:.0f} min",
+            key=f"stale-{device.name}"
+        )
+
+
+def _write():
+    path = _path()
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump({name: d.as_dict() for name, d in _devices.items()}, f)
+    os.replace(tmp, path)
+
+
+async def _snapshot():
+    try:
+        _write()
+    except (OSError, TypeError, ValueError) as exc:
+        logger.error(f"unable to snapshot the registry ({exc!r})")
+
+
+async def close():
+    if config.registry.enabled:
+        await _snapshot()
+    _devices.clear()
+    _subscribers.clear()
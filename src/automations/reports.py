@@ -0,0 +1,296 @@
+# Daily and monthly energy reports: consumption and peak apparent power of
+# the linky meters, temperature statistics of the temperature_humidity
+# devices. The days are aggregated in worker processes, from the database,
+# the archive and the rollups, and the aggregates of the closed days and
+# months are stored in the report table so that they are never computed
+# again. The report command runs out of the daemon, from cron
+# (scripts/domotik-report)
+
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+import json
+import logging
+import os
+from pathlib import Path
+import sqlite3
+
+import automations.archive as archive
+import automations.config as config
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# read-only connection of a worker process
+_conn = None
+
+
+def _min(a, b):
+    return b if a is None or (b is not None and b < a) else a
+
+
+def _max(a, b):
+    return b if a is None or (b is not None and b > a) else a
+
+
+def _init_worker(config_filename: str):
+    global _conn
+
+    config.read(config_filename)
+    _conn = sqlite3.connect(
+        f"file:{Path(config.database.path).expanduser()}?mode=ro", uri=True,
+        timeout=config.database.busy_timeout / 1000
+    )
+
+
+def _bounds(day: str) -> tuple[int, int]:
+    """Unix timestamps of the start and the end of a local day"""
+    start = datetime.fromisoformat(day)
+    return int(start.timestamp()), int((start + timedelta(days=1)).timestamp())
+
+
+def _linky(start: int, end: int) -> dict:
+    """source -> [east min, east max, sinst max, time of sinst max]"""
+    meters: dict = {}
+
+    def merge(source, east_min, east_max, sinst_max, sinst_time):
+        meter = meters.setdefault(source, [None, None, None, None])
+        meter[0] = _min(meter[0], east_min)
+        meter[1] = _max(meter[1], east_max)
+        if sinst_max is not None and (meter[2] is None or sinst_max > meter[2]):
+            meter[2], meter[3] = sinst_max, sinst_time
+
+    if config.archive.enabled and "linky" in config.archive.tables:
+        names = ["timestamp", "source", "east", "sinst"]
+        for rows in archive.read("linky", names, start, end - 1):
+            by_source: dict = {}
+            for row in rows:
+                by_source.setdefault(row[1], []).append(row)
+            # column-wise aggregates of the block
+            for source, source_rows in by_source.items():
+                timestamps, _, easts, sinsts = zip(*source_rows)
+                easts = [e for e in easts if e is not None]
+                peak = max(
+                    (s, t) for s, t in zip(sinsts, timestamps) if s is not None
+                ) if any(s is not None for s in sinsts) else (None, None)
+                merge(source, min(easts, default=None), max(easts, default=None), *peak)
+
+    east = _conn.execute(
+        "SELECT source, MIN(east), MAX(east) FROM linky "
+        "WHERE timestamp >= ? AND timestamp < ? GROUP BY source",
+        (start, end)
+    ).fetchall()
+    # the bare timestamp column is the one of the MAX row
+    sinst = dict(
+        (source, (peak, timestamp)) for source, peak, timestamp in _conn.execute(
+            "SELECT source, MAX(sinst), timestamp FROM linky "
+            "WHERE timestamp >= ? AND timestamp < ? GROUP BY source",
+            (start, end)
+        )
+    )
+    for source, east_min, east_max in east:
+        merge(source, east_min, east_max, *sinst.get(source, (None, None)))
+
+    return meters
+
+
+def _temperatures(start: int, end: int) -> dict:
+    """(device, source) -> [min, max, sum, count], from the hourly rollups:
+    they aggregate all the samples, the raw rows only the ones stored by the
+    deadband"""
+    devices: dict = {}
+    for series, *stats in _conn.execute(
+        "SELECT series, MIN(min), MAX(max), SUM(sum), SUM(count) FROM rollup "
+        "WHERE resolution = 3600 AND bucket >= ? AND bucket < ? "
+        "AND series GLOB 'temperature_humidity.*.temperature' GROUP BY series",
+        (start, end)
+    ):
+        # temperature_humidity[.source].device.temperature
+        parts = series.split(".")
+        devices[(parts[-2], parts[1] if len(parts) == 4 else None)] = stats
+    return devices
+
+
+def _day(day: str) -> dict[str, float]:
+    """Aggregates of a day (YYYY-MM-DD), run in a worker process. The energy
+    is the difference of the east indexes of the first and last rows of the
+    day"""
+    start, end = _bounds(day)
+    values = {"days": 1}
+
+    for source, (east_min, east_max, sinst_max, sinst_time) in _linky(start, end).items():
+        prefix = f"linky.{source}." if source else "linky."
+        if east_min is not None:
+            values[f"{prefix}energy"] = east_max - east_min
+        if sinst_max is not None:
+            values[f"{prefix}sinst_max"] = sinst_max
+            values[f"{prefix}sinst_max_time"] = sinst_time
+
+    for (device, source), (minimum, maximum, total, count) in _temperatures(start, end).items():
+        prefix = f"temperature.{source}.{device}." if source else f"temperature.{device}."
+        values[f"{prefix}min"] = minimum
+        values[f"{prefix}max"] = maximum
+        values[f"{prefix}sum"] = total
+        values[f"{prefix}count"] = count
+
+    return values
+
+
+def _month(days: dict[str, dict]) -> dict[str, float]:
+    """Aggregate the values of the days of a month"""
+    values: dict = {}
+    for day in sorted(days):
+        for key, value in days[day].items():
+            kind = key.rsplit(".", 1)[-1]
+            if key not in values:
+                values[key] = value
+            elif kind in ("days", "energy", "sum", "count"):
+                values[key] += value
+            elif kind == "min":
+                values[key] = min(values[key], value)
+            elif kind in ("max", "sinst_max") and value > values[key]:
+                values[key] = value
+                if kind == "sinst_max":
+                    values[f"{key}_time"] = days[day][f"{key}_time"]
+    return values
+
+
+def _memoized(conn, first: str, last: str) -> dict[str, dict]:
+    periods: dict[str, dict] = {}
+    for period, key, value in conn.execute(
+        "SELECT period, key, value FROM report WHERE period >= ? AND period <= ?",
+        (first, last)
+    ):
+        periods.setdefault(period, {})[key] = value
+    return periods
+
+
+def _memoize(conn, periods: dict[str, dict]):
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO report(period, key, value) VALUES (?, ?, ?)",
+            [
+                (period, key, value)
+                for period, values in periods.items() for key, value in values.items()
+            ]
+        )
+
+
+def _days(conn, config_filename: str, days: list[str]) -> dict[str, dict]:
+    """Return the aggregates of the days, the ones not memoized yet being
+    computed in parallel by worker processes"""
+    results = _memoized(conn, days[0], days[-1])
+    missing = [day for day in days if day not in results]
+    if not missing:
+        return results
+
+    logger.info(f"computing {len(missing)} days")
+    with ProcessPoolExecutor(
+        max_workers=min(config.reports.workers or os.cpu_count() or 1, len(missing)),
+        initializer=_init_worker, initargs=(config_filename,)
+    ) as pool:
+        results.update(zip(missing, pool.map(_day, missing)))
+
+    # the current day is not closed yet
+    today = date.today().isoformat()
+    _memoize(conn, {day: results[day] for day in missing if day < today})
+    return results
+
+
+def _format(period: str, values: dict, days: dict[str, dict] | None = None) -> str:
+    lines = [f"Rapport du {period}" if days is None else f"Rapport de {period}", ""]
+    for key in sorted(values):
+        value = values[key]
+        name = key.rsplit(".", 1)[0]
+        if key.endswith(".energy"):
+            lines.append(f"Consommation {name} : {value / 1000:.2f} kWh")
+        elif key.endswith(".sinst_max"):
+            when = datetime.fromtimestamp(values[f"{key}_time"]).strftime("%d/%m %H:%M")
+            lines.append(f"Puissance apparente max {name} : {value:.0f} VA ({when})")
+        elif key.endswith(".count") and value:
+            lines.append(
+                f"Température {name.split('.', 1)[1]} : min {values[name + '.min']:.1f} °C, "
+                f"max {values[name + '.max']:.1f} °C, "
+                f"moyenne {values[name + '.sum'] / value:.1f} °C"
+            )
+
+    if days is not None:
+        lines.append("")
+        for day in sorted(days):
+            energy = [(k, v) for k, v in days[day].items() if k.endswith(".energy")]
+            text = ", ".join(f"{k.rsplit('.', 1)[0]} {v / 1000:.2f} kWh" for k, v in energy)
+            lines.append(f"{day} : {text or '-'}")
+
+    return "\n".join(lines) + "\n"
+
+
+def _deliver(period: str, text: str, data: dict):
+    if config.reports.output_dir:
+        output_dir = Path(config.reports.output_dir).expanduser()
+        output_dir.mkdir(parents=True, exist_ok=True)
+        (output_dir / f"{period}.txt").write_text(text)
+        (output_dir / f"{period}.json").write_text(json.dumps(data, indent=2))
+
+    if config.reports.email:
+        # the email goes through the outbox sending path, which loads the
+        # daemon database module: imported only when needed
+        import automations.outbox as outbox
+
+        asyncio.run(outbox.send_email(f"Rapport énergie {period}", text))
+
+
+def run(config_filename: str, day: str | None = None, month: str | None = None):
+    """Report a day (YYYY-MM-DD, yesterday by default) or a month (YYYY-MM)"""
+    config.read(config_filename)
+
+    conn = sqlite3.connect(
+        config.database.path, timeout=config.database.busy_timeout / 1000
+    )
+    try:
+        if month is None:
+            day = day or (date.today() - timedelta(days=1)).isoformat()
+            values = _days(conn, config_filename, [day])[day]
+            text = _format(day, values)
+            _deliver(day, text, {"period": day, "values": values})
+            return
+
+        first = date.fromisoformat(f"{month}-01")
+        year, number = divmod(first.month, 12)
+        end = date(first.year + year, number + 1, 1)
+        days = [
+            (first + timedelta(days=i)).isoformat() for i in range((end - first).days)
+            if first + timedelta(days=i) <= date.today()
+        ]
+
+        memoized = _memoized(conn, month, month).get(month)
+        days_values = _days(conn, config_filename, days) if days else {}
+        values = memoized or _month(days_values)
+        if memoized is None and end <= date.today():
+            _memoize(conn, {month: values})
+
+        text = _format(month, values, days_values)
+        _deliver(month, text, {"period": month, "values": values, "days": days_values})
+    except (sqlite3.Error, OSError, ValueError) as exc:
+        logger.error(f"error while reporting ({exc!r})")
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", default="config.toml")
+    parser.add_argument("--day", metavar="YYYY-MM-DD", help="day to report, yesterday by default")
+    parser.add_argument(
+        "--month", nargs="?", const="", metavar="YYYY-MM",
+        help="report a month, the previous one by default"
+    )
+    args = parser.parse_args()
+
+    month = args.month
+    if month == "":
+        month = (date.today().replace(day=1) - timedelta(days=1)).strftime("%Y-%m")
+    run(args.config, args.day, month)
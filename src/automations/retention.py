@@ -0,0 +1,107 @@
+import asyncio
+from contextlib import aclosing
+import logging
+from time import time
+
+import automations.archive as archive
+import automations.config as config
+from automations.db import execute_count
+from automations.db import fetch_all
+from automations.db import incremental_vacuum
+from automations.db import iterate
+
+_ROLLUP_RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+async def _delete(table: str, key: str, condition: str, *args) -> int:
+    # small batches, each in its own transaction, so that the write lock is
+    # held for a short time only and buffered inserts can interleave
+    total = 0
+    while True:
+        count = await execute_count(
+            f"DELETE FROM {table} WHERE {key} IN ("
+            f"    SELECT {key.strip('()')} FROM {table} WHERE {condition} LIMIT ?"
+            ")",
+            *args, config.retention.batch_size
+        )
+        total += count
+        if count < config.retention.batch_size:
+            return total
+        await asyncio.sleep(config.retention.pause)
+
+
+async def _archive(table: str, before: int) -> int | None:
+    """Archive the rows of `table` older than `before`, return the highest
+    archived rowid or None if no row was archived"""
+    names = [row[1] for row in await fetch_all(f"PRAGMA table_info({table})")]
+    if "timestamp" not in names:
+        logger.error(f"unable to archive {table}, no timestamp column")
+        return None
+
+    last_rowid = None
+    chunk: list = []
+
+    async def write():
+        nonlocal last_rowid
+        # encoding and writing are done in a thread, not to block the loop
+        await asyncio.to_thread(archive.append, table, names, [row[1:] for row in chunk])
+        last_rowid = chunk[-1][0]
+        chunk.clear()
+
+    batches = iterate(table, ["rowid"] + names, "timestamp < ?", before)
+    try:
+        async with aclosing(batches):
+            async for rows in batches:
+                chunk.extend(rows)
+                if len(chunk) >= config.archive.chunk_rows:
+                    await write()
+        if chunk:
+            await write()
+    except (OSError, ValueError) as exc:
+        logger.error(f"error while archiving {table} ({exc})")
+
+    return last_rowid
+
+
+async def run():
+    """Archive and delete the expired rows, then release the free pages by
+    small steps"""
+    now = int(time())
+
+    for table, days in config.retention.tables.items():
+        before = now - int(days * 86400)
+        if config.archive.enabled and table in config.archive.tables:
+            # only the archived rows are deleted
+            last_rowid = await _archive(table, before)
+            if last_rowid is None:
+                continue
+            count = await _delete(
+                table, "rowid", "timestamp < ? AND rowid <= ?", before, last_rowid
+            )
+        else:
+            count = await _delete(table, "rowid", "timestamp < ?", before)
+        if count > 0:
+            logger.info(f"{count} rows deleted from {table}")
+
+    for name, days in config.retention.rollup.items():
+        # rollup is a WITHOUT ROWID table, delete on its primary key instead
+        count = await _delete(
+            "rollup", "(series, resolution, bucket)", "resolution = ? AND bucket < ?",
+            _ROLLUP_RESOLUTIONS[name], now - int(days * 86400)
+        )
+        if count > 0:
+            logger.info(f"{count} {name} rollups deleted")
+
+    free_pages = None
+    while True:
+        left = await incremental_vacuum(config.retention.vacuum_pages)
+        # stop when done, or when nothing can be released (auto_vacuum not
+        # enabled)
+        if left == 0 or left == free_pages:
+            break
+        free_pages = left
+        await asyncio.sleep(config.retention.pause)
@@ -0,0 +1,79 @@
+# Incremental per-minute/hour/day aggregates of the sensor tables, stored in
+# the rollup table: the average is sum / count and the energy consumed in a
+# bucket is the difference of `last` with the previous bucket of linky.east.
+# The rows tagged with the source of a domio hub have their own series
+# (linky.<source>.east)
+
+RESOLUTIONS = (60, 3600, 86400)
+
+# table -> (name of the device column or None, aggregated columns)
+SERIES = {
+    "linky": (None, ("east", "sinst")),
+    "pressure": (None, ("pressure",)),
+    "temperature_humidity": ("device", ("humidity", "temperature")),
+}
+
+COLUMNS = ("series", "resolution", "bucket", "count", "min", "max", "sum", "first", "last")
+
+UPSERT = (
+    f"INSERT INTO rollup({', '.join(COLUMNS)}) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(series, resolution, bucket) DO UPDATE SET "
+    "    count = count + excluded.count,"
+    "    min = MIN(min, excluded.min),"
+    "    max = MAX(max, excluded.max),"
+    "    sum = sum + excluded.sum,"
+    "    last = excluded.last"
+)
+
+
+def series_name(table: str, column: str, device: str | None = None) -> str:
+    if device is None:
+        return f"{table}.{column}"
+    return f"{table}.{device}.{column}"
+
+
+def aggregate(buffer: dict) -> list[tuple]:
+    """Pre-aggregate samples ({(table, columns): rows}) into parameters for
+    UPSERT. Every sample is aggregated, including the ones the deadband does
+    not store, so that the means are over time and not over the changes"""
+    buckets: dict[tuple, list] = {}
+
+    for (table, columns), rows in buffer.items():
+        spec = SERIES.get(table)
+        if spec is None:
+            continue
+        device_column, value_columns = spec
+
+        ts_index = columns.index("timestamp")
+        device_index = columns.index(device_column) if device_column else None
+        source_index = columns.index("source") if "source" in columns else None
+        indexes = [(c, columns.index(c)) for c in value_columns if c in columns]
+
+        for row in rows:
+            timestamp = row[ts_index]
+            device = row[device_index] if device_index is not None else None
+            if source_index is not None and row[source_index] is not None:
+                source = row[source_index]
+                device = source if device is None else f"{source}.{device}"
+            for column, index in indexes:
+                value = row[index]
+                if value is None:
+                    continue
+                series = series_name(table, column, device)
+                for resolution in RESOLUTIONS:
+                    key = (series, resolution, timestamp - timestamp % resolution)
+                    agg = buckets.get(key)
+                    if agg is None:
+                        # count, min, max, sum, first, last
+                        buckets[key] = [1, value, value, value, value, value]
+                    else:
+                        agg[0] += 1
+                        if value < agg[1]:
+                            agg[1] = value
+                        if value > agg[2]:
+                            agg[2] = value
+                        agg[3] += value
+                        agg[5] = value
+
+    return [key + tuple(agg) for key, agg in buckets.items()]
@@ -0,0 +1,166 @@
+import asyncio
+from functools import lru_cache
+import logging
+from typing import Awaitable
+from typing import Callable
+
+import automations.metrics as metrics
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class _Node:
+    __slots__ = ("children", "handlers")
+
+    def __init__(self):
+        self.children = {}
+        self.handlers = []
+
+
+class _Handler:
+    __slots__ = ("name", "topic_filter", "func", "queue", "task", "dropped")
+
+    def __init__(self, name: str, topic_filter: str, func: Callable, queue_size: int):
+        self.name = name
+        self.topic_filter = topic_filter
+        self.func = func
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.task = None
+        self.dropped = 0
+
+
+_MESSAGES = metrics.counter(
+    "automations_mqtt_messages_total", "MQTT messages received", ("topic",)
+)
+_DROPPED = metrics.counter(
+    "automations_mqtt_dropped_total", "MQTT messages dropped by overloaded handlers",
+    ("handler",)
+)
+
+_filters: list[str] = []
+_handlers: list[_Handler] = []
+_root = _Node()
+
+
+def register(
+    topic_filter: str, func: Callable[..., Awaitable], queue_size: int = 100,
+    name: str | None = None
+):
+    """Call `func(message)` for every message whose topic matches
+    `topic_filter`. Each handler runs in its own task and consumes a bounded
+    queue: when the queue is full, messages for this handler are dropped"""
+    handler = _Handler(name or func.__name__, topic_filter, func, queue_size)
+    handler.task = asyncio.create_task(_worker(handler), name=handler.name)
+
+    node = _root
+    for level in topic_filter.split("/"):
+        node = node.children.setdefault(level, _Node())
+    node.handlers.append(handler)
+
+    _filters.append(topic_filter)
+    _handlers.append(handler)
+    _match.cache_clear()
+
+
+async def unregister(name: str):
+    """Remove the handler `name`, the messages left in its queue are
+    dropped"""
+    for handler in _handlers:
+        if handler.name == name:
+            break
+    else:
+        return
+
+    node = _root
+    for level in handler.topic_filter.split("/"):
+        node = node.children[level]
+    node.handlers.remove(handler)
+
+    _filters.remove(handler.topic_filter)
+    _handlers.remove(handler)
+    _match.cache_clear()
+
+    handler.task.cancel()
+    await asyncio.gather(handler.task, return_exceptions=True)
+
+
+def filters() -> list[str]:
+    return list(_filters)
+
+
+@lru_cache(maxsize=1024)
+def _match(topic: str) -> tuple[_Handler, ...]:
+    matches = {}  # preserve registration order and remove duplicates
+
+    nodes = [_root]
+    for i, level in enumerate(topic.split("/")):
+        next_nodes = []
+        for node in nodes:
+            # wildcards do not match topics starting with $ (MQTT spec)
+            if not (i == 0 and level.startswith("$")):
+                multi = node.children.get("#")
+                if multi is not None:
+                    matches.update(dict.fromkeys(multi.handlers))
+                single = node.children.get("+")
+                if single is not None:
+                    next_nodes.append(single)
+            child = node.children.get(level)
+            if child is not None:
+                next_nodes.append(child)
+        nodes = next_nodes
+        if not nodes:
+            break
+
+    for node in nodes:
+        matches.update(dict.fromkeys(node.handlers))
+        # "a/#" also matches "a"
+        multi = node.children.get("#")
+        if multi is not None:
+            matches.update(dict.fromkeys(multi.handlers))
+
+    return tuple(matches)
+
+
+def dispatch(message):
+    topic = message.topic.value
+    _MESSAGES.inc(topic)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("mqtt message, topic: %s, payload: %s", topic, message.payload)
+
+    for handler in _match(topic):
+        try:
+            handler.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            handler.dropped += 1
+            _DROPPED.inc(handler.name)
+            logger.warning("handler %s is overloaded, message dropped", handler.name)
+
+
+async def _worker(handler: _Handler):
+    while True:
+        message = await handler.queue.get()
+        try:
+            await handler.func(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.error(
+                f"{handler.name} failed on {message.topic.value}",
+                exc_info=(type(exc), exc, exc.__traceback__)
+            )
+
+
+async def close():
+    global _root
+
+    tasks = [h.task for h in _handlers]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    _filters.clear()
+    _handlers.clear()
+    _root = _Node()
+    _match.cache_clear()
@@ -0,0 +1,378 @@
+from datetime import datetime
+from datetime import time
+from functools import partial
+import logging
+import operator
+from time import monotonic
+from typing import Awaitable
+from typing import Callable
+
+import automations.config as config
+from automations.db import insert
+import automations.decoders as decoders
+from automations.filters import TimeWindow
+import automations.metrics as metrics
+import automations.outbox as outbox
+import automations.registry as registry
+import automations.router as router
+import automations.scheduler as scheduler
+from automations.typem import RuleConfig
+
+_OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+
+class _Fields(dict):
+    """Event fields used to format the action strings, unknown fields are
+    left as is"""
+
+    def __missing__(self, key):
+        return f"{{{key}}}"
+
+
+class _Condition:
+    __slots__ = ("field", "op", "value")
+
+    def __init__(self, field: str, op: str, value):
+        self.field = field
+        self.op = _OPERATORS[op]
+        self.value = value
+
+    def __call__(self, fields: dict) -> bool:
+        value = fields.get(self.field)
+        if value is None:
+            return False
+        try:
+            return self.op(value, self.value)
+        except TypeError:
+            return False
+
+
+class _Rule:
+    __slots__ = (
+        "name", "conditions", "actions", "field", "above", "threshold", "hysteresis",
+        "aggregate", "window", "hours", "crossed"
+    )
+
+    def __init__(self, name: str):
+        self.name = name
+        self.conditions: list[_Condition] = []
+        self.actions: list[Callable[[dict], Awaitable]] = []
+        # threshold crossing triggers
+        self.field = None
+        self.above = True
+        self.threshold = None
+        self.hysteresis = 0.0
+        self.aggregate = "value"
+        self.window: TimeWindow | None = None
+        self.hours: list[tuple[time, time]] = []
+        self.crossed = False
+
+    def value(self, values: dict) -> float | None:
+        if self.window is None:
+            return values.get(self.field)
+        if not self.window.covered():
+            # after a start, or a reload creating the window
+            return None
+        if self.aggregate == "rate":
+            rate = self.window.rate()
+            # change per hour, W for energy indexes in Wh
+            return rate * 3600 if rate is not None else None
+        return getattr(self.window, self.aggregate)()
+
+    def active(self, now: time) -> bool:
+        if not self.hours:
+            return True
+        for start, end in self.hours:
+            if start <= end:
+                if start <= now < end:
+                    return True
+            elif now >= start or now < end:
+                # the time range spans midnight
+                return True
+        return False
+
+
+_FIRED = metrics.counter("automations_rules_fired_total", "Rules fired", ("rule",))
+
+# rules indexed by the MQTT topic filter and by the source of their trigger,
+# so that an event is only evaluated against the rules it can fire
+_by_source: dict[str, list[_Rule]] = {}
+_by_topic: dict[str, list[_Rule]] = {}
+# last sample of each source
+_latest: dict[str, dict] = {}
+# sliding windows of the sources, shared by the rules using the same field
+# and duration: source -> (field, duration) -> window
+_windows: dict[str, dict[tuple[str, float], TimeWindow]] = {}
+# names of the scheduler jobs of the cron rules
+_crons: list[str] = []
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _render(value, fields: _Fields):
+    if isinstance(value, str):
+        return value.format_map(fields)
+    if isinstance(value, dict):
+        return {k: _render(v, fields) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_render(v, fields) for v in value]
+    return value
+
+
+async def _publish(topic: str, payload: dict, key: str | None, fields: _Fields):
+    await outbox.publish(_render(topic, fields), _render(payload, fields), key=key)
+
+
+async def _email(subject: str, content: str, key: str | None, fields: _Fields):
+    await outbox.email(_render(subject, fields), _render(content, fields), key=key)
+
+
+async def _insert(table: str, values: dict, fields: _Fields):
+    row = _render(values, fields)
+    await insert(table, **row)
+    if "device" in row:
+        # events like the doorbell presses
+        registry.update(row["device"], **{k: v for k, v in row.items() if k != "device"})
+
+
+async def _log(message: str, level: int, fields: _Fields):
+    logger.log(level, _render(message, fields))
+
+
+def _compile_action(action: dict) -> Callable[[dict], Awaitable]:
+    if "publish" in action:
+        return partial(
+            _publish, action["publish"], action.get("payload", {}), action.get("key")
+        )
+    if "email" in action:
+        return partial(_email, action["email"], action.get("content", ""), action.get("key"))
+    if "insert" in action:
+        return partial(_insert, action["insert"], action.get("values", {}))
+    if "log" in action:
+        level = getattr(logging, action.get("level", "info").upper())
+        return partial(_log, action["log"], level)
+    raise ValueError(f"unknown action {action}")
+
+
+def _compile_threshold(rule: _Rule, trigger: dict):
+    source = trigger["source"]
+    rule.field = trigger["field"]
+    rule.above = "above" in trigger
+    rule.threshold = trigger["above"] if rule.above else trigger["below"]
+    rule.hysteresis = trigger.get("hysteresis", 0.0)
+
+    rule.aggregate = trigger.get("aggregate", "value")
+    if rule.aggregate != "value":
+        if rule.aggregate not in ("mean", "max", "rate"):
+            raise ValueError(f"unknown aggregate {rule.aggregate}")
+        key = (rule.field, float(trigger["window"]))
+        windows = _windows.setdefault(source, {})
+        if key not in windows:
+            windows[key] = TimeWindow(key[1])
+        rule.window = windows[key]
+
+    for hours in trigger.get("hours", []):
+        start, end = hours.split("-")
+        rule.hours.append((time.fromisoformat(start), time.fromisoformat(end)))
+
+    _by_source.setdefault(source, []).append(rule)
+
+
+def _compile(rule_config: RuleConfig) -> _Rule:
+    rule = _Rule(rule_config.name)
+    trigger = rule_config.trigger
+
+    try:
+        rule.conditions = [
+            _Condition(c["field"], c.get("op", "=="), c["value"])
+            for c in rule_config.conditions
+        ]
+        rule.actions = [_compile_action(a) for a in rule_config.actions]
+
+        if "topic" in trigger:
+            _by_topic.setdefault(trigger["topic"], []).append(rule)
+        elif "cron" in trigger:
+            # check the expression now rather than when scheduling
+            scheduler.Cron(trigger["cron"])
+        elif "field" in trigger:
+            _compile_threshold(rule, trigger)
+        else:
+            raise ValueError(f"unknown trigger {trigger}")
+    except (KeyError, ValueError, AttributeError) as exc:
+        raise ValueError(f"invalid rule {rule_config.name}: {exc!r}") from exc
+
+    return rule
+
+
+def _compile_all() -> list[tuple[_Rule, dict]]:
+    """Compile the rules of the configuration, return the cron rules and
+    their trigger"""
+    schedules = []
+    for rule_config in config.rules:
+        rule = _compile(rule_config)
+        if "cron" in rule_config.trigger:
+            schedules.append((rule, rule_config.trigger))
+    return schedules
+
+
+def _register(schedules: list[tuple[_Rule, dict]]):
+    for topic_filter, rules in _by_topic.items():
+        router.register(
+            topic_filter, partial(_on_message, rules), name=f"rules:{topic_filter}"
+        )
+
+    for rule, trigger in schedules:
+        scheduler.add_cron(
+            f"rule-{rule.name}", trigger["cron"],
+            partial(_on_schedule, rule, trigger.get("source"))
+        )
+        _crons.append(f"rule-{rule.name}")
+
+
+def init():
+    """Compile the rules of the configuration and register their triggers"""
+    _register(_compile_all())
+    logger.info(f"{len(config.rules)} rules loaded")
+
+
+async def reload():
+    """Replace the rules by those of the configuration. The current rules are
+    kept if the new ones are invalid (ValueError). The sliding windows still
+    used, and the state of the rules keeping their name, are preserved"""
+    by_source = dict(_by_source)
+    by_topic = dict(_by_topic)
+    windows = {source: dict(w) for source, w in _windows.items()}
+
+    _by_source.clear()
+    _by_topic.clear()
+    # the new rules find the windows of the same source, field and duration
+    try:
+        schedules = _compile_all()
+    except ValueError:
+        _by_source.clear()
+        _by_source.update(by_source)
+        _by_topic.clear()
+        _by_topic.update(by_topic)
+        _windows.clear()
+        _windows.update(windows)
+        raise
+
+    crossed = {r.name: r.crossed for rules in by_source.values() for r in rules}
+    used = set()
+    for rules in _by_source.values():
+        for rule in rules:
+            rule.crossed = crossed.get(rule.name, False)
+            if rule.window is not None:
+                used.add(id(rule.window))
+    for source_windows in _windows.values():
+        for key, window in list(source_windows.items()):
+            if id(window) not in used:
+                del source_windows[key]
+
+    for topic_filter in by_topic:
+        await router.unregister(f"rules:{topic_filter}")
+    for name in _crons:
+        scheduler.remove(name)
+    _crons.clear()
+
+    _register(schedules)
+    logger.info(f"{len(config.rules)} rules reloaded")
+
+
+async def _fire(rule: _Rule, fields: _Fields):
+    if not all(condition(fields) for condition in rule.conditions):
+        return
+
+    logger.debug(f"rule {rule.name} fired")
+    _FIRED.inc(rule.name)
+    for action in rule.actions:
+        await action(fields)
+
+
+async def _on_message(rules: list[_Rule], message):
+    topic = message.topic.value
+    fields = _Fields(topic=topic, device=topic.split("/")[-1])
+    if message.payload:
+        try:
+            payload = decoders.loads(message.payload)
+        except ValueError:
+            payload = message.payload.decode(errors="replace")
+        if isinstance(payload, dict):
+            fields.update(payload)
+        else:
+            fields["payload"] = payload
+
+    for rule in rules:
+        await _fire(rule, fields)
+
+
+async def _on_schedule(rule: _Rule, source: str | None):
+    fields = _Fields()
+    if source is not None:
+        sample = _latest.get(source)
+        if sample is None:
+            logger.warning(f"rule {rule.name}: no {source} sample yet")
+            return
+        fields.update(sample, source=source)
+
+    await _fire(rule, fields)
+
+
+async def sample(source: str, /, **values):
+    """Feed a new sample of `source` to the rules triggered by its threshold
+    crossings. The rules are evaluated incrementally on the sliding windows
+    of the source, without querying the database"""
+    _latest[source] = values
+
+    rules = _by_source.get(source)
+    if not rules:
+        return
+
+    t = monotonic()
+    for (field, _), window in _windows.get(source, {}).items():
+        value = values.get(field)
+        if value is not None:
+            window.update(t, value)
+
+    now = datetime.now().time()
+    for rule in rules:
+        if not rule.active(now):
+            # re-armed when entering the rule hours
+            rule.crossed = False
+            continue
+
+        value = rule.value(values)
+        if value is None:
+            continue
+
+        # fire once when the threshold is crossed, then wait for the value to
+        # come back beyond the hysteresis before firing again
+        if rule.above:
+            crossed = value > rule.threshold
+            cleared = value <= rule.threshold - rule.hysteresis
+        else:
+            crossed = value < rule.threshold
+            cleared = value >= rule.threshold + rule.hysteresis
+
+        if crossed and not rule.crossed:
+            rule.crossed = True
+            await _fire(rule, _Fields(values, source=source, value=value))
+        elif cleared:
+            rule.crossed = False
+
+
+def close():
+    _by_source.clear()
+    _crons.clear()
+    _by_topic.clear()
+    _latest.clear()
+    _windows.clear()
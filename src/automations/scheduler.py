@@ -0,0 +1,200 @@
+import asyncio
+from dataclasses import dataclass
+from dataclasses import field
+from datetime import datetime
+from datetime import timedelta
+from functools import partial
+import logging
+from math import ceil
+from typing import Awaitable
+from typing import Callable
+
+import automations.metrics as metrics
+from automations.utils import done_callback
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class Cron:
+    """Cron expression with the usual five fields: minute, hour, day of month,
+    month and day of week (0 or 7 is sunday). Each field accepts `*`, numbers,
+    ranges, lists and steps"""
+
+    _BOUNDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"invalid cron expression '{expression}'")
+
+        values = [
+            self._parse_field(f, lo, hi) for f, (lo, hi) in zip(fields, self._BOUNDS)
+        ]
+        self.minutes, self.hours, self.days, self.months, weekdays = values
+        # cron uses 0 or 7 for sunday, python uses 6
+        self.weekdays = {(d - 1) % 7 for d in weekdays}
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+        self.expression = expression
+
+    @staticmethod
+    def _parse_field(text: str, lo: int, hi: int) -> set[int]:
+        values = set()
+        for part in text.split(","):
+            rng, _, step = part.partition("/")
+            if rng == "*":
+                start, stop = lo, hi
+            elif "-" in rng:
+                start, stop = (int(v) for v in rng.split("-"))
+            else:
+                start = stop = int(rng)
+                if step:
+                    stop = hi
+            if not lo <= start <= stop <= hi:
+                raise ValueError(f"invalid cron field '{text}'")
+            values.update(range(start, stop + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, dt: datetime) -> bool:
+        day = dt.day in self.days
+        weekday = dt.weekday() in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        # like cron, day of month and day of week are or-ed when both are set
+        return day or weekday
+
+    def next(self, after: datetime) -> datetime:
+        """Return the first matching time strictly after `after`"""
+        dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # 5 years is enough to find any valid date (february 29th included)
+        limit = dt + timedelta(days=5 * 366)
+        while dt < limit:
+            if dt.month not in self.months:
+                year, month = divmod(dt.month, 12)
+                dt = dt.replace(year=dt.year + year, month=month + 1, day=1, hour=0, minute=0)
+            elif not self._day_matches(dt):
+                dt = (dt + timedelta(days=1)).replace(hour=0, minute=0)
+            elif dt.hour not in self.hours:
+                dt = (dt + timedelta(hours=1)).replace(minute=0)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError(f"cron expression '{self.expression}' never matches")
+
+
+@dataclass
+class _Job:
+    name: str
+    func: Callable[[], Awaitable]
+    period: float | None = None
+    cron: Cron | None = None
+    deadline: float = 0.0
+    handle: asyncio.TimerHandle | None = None
+    tasks: set = field(default_factory=set)
+
+
+_RUNS = metrics.counter("automations_job_runs_total", "Scheduled job runs", ("job", "status"))
+
+_jobs: dict[str, _Job] = {}
+
+
+def _cron_deadline(loop, cron: Cron) -> float:
+    now = datetime.now()
+    return loop.time() + (cron.next(now) - now).total_seconds()
+
+
+def _count_run(name: str, task: asyncio.Task):
+    if task.cancelled():
+        _RUNS.inc(name, "cancelled")
+    elif task.exception() is not None:
+        _RUNS.inc(name, "error")
+    else:
+        _RUNS.inc(name, "ok")
+
+
+def _arm(job: _Job):
+    loop = asyncio.get_running_loop()
+    job.handle = loop.call_at(job.deadline, _fire, job)
+
+
+def _fire(job: _Job):
+    loop = asyncio.get_running_loop()
+
+    if job.tasks:
+        logger.warning(f"job {job.name} still running, skipping this run")
+    else:
+        task = asyncio.create_task(job.func(), name=job.name)
+        task.add_done_callback(partial(done_callback, logger))
+        task.add_done_callback(job.tasks.discard)
+        task.add_done_callback(partial(_count_run, job.name))
+        job.tasks.add(task)
+
+    if job.period is not None:
+        # fixed rate: deadlines are multiples of the period, so they do not
+        # drift; runs missed while the loop was blocked are skipped
+        job.deadline += job.period
+        late = loop.time() - job.deadline
+        if late > 0:
+            job.deadline += ceil(late / job.period) * job.period
+    else:
+        job.deadline = _cron_deadline(loop, job.cron)
+    _arm(job)
+
+
+def add_interval(name: str, period: float, func: Callable[[], Awaitable], delay: float | None = None):
+    """Run `func` every `period` seconds. The first run occurs after `delay`
+    seconds (one period by default)"""
+    tasks = _replace(name)
+
+    loop = asyncio.get_running_loop()
+    job = _Job(name, func, period=period, tasks=tasks)
+    job.deadline = loop.time() + (period if delay is None else delay)
+    _jobs[name] = job
+    _arm(job)
+
+
+def add_cron(name: str, expression: str, func: Callable[[], Awaitable]):
+    """Run `func` at the times matching the cron `expression` (local time)"""
+    tasks = _replace(name)
+
+    loop = asyncio.get_running_loop()
+    job = _Job(name, func, cron=Cron(expression), tasks=tasks)
+    job.deadline = _cron_deadline(loop, job.cron)
+    _jobs[name] = job
+    _arm(job)
+
+
+def _replace(name: str) -> set:
+    job = _jobs.pop(name, None)
+    if job is None:
+        return set()
+    if job.handle is not None:
+        job.handle.cancel()
+    # the run in progress is carried over to the job replacing this one, so
+    # it is not run twice at the same time and close() still waits for it
+    return job.tasks
+
+
+def remove(name: str):
+    """Stop the job `name` and cancel its run in progress"""
+    for task in _replace(name):
+        task.cancel()
+
+
+async def close():
+    jobs = list(_jobs.values())
+    _jobs.clear()
+
+    tasks = []
+    for job in jobs:
+        if job.handle is not None:
+            job.handle.cancel()
+        for task in job.tasks:
+            task.cancel()
+            tasks.append(task)
+
+    # task exceptions are handled by the done callback
+    await asyncio.gather(*tasks, return_exceptions=True)
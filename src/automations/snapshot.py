@@ -1,40 +1,167 @@
 import argparse
-import asyncio
+from calendar import timegm
+from http.client import HTTPConnection
+from http.client import HTTPException
+import json
 import logging
+from pathlib import Path
+import sqlite3
+from time import sleep
+from time import strptime
+from time import time
 
-import aiohttp
-
+import automations.archive as archive
 import automations.config as config
-import automations.db as db
+from automations.typem import HubConfig
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# one GET and one INSERT per run: the standard library starts much faster
+# than aiohttp and the daemon database module (see automations
+# --import-report automations.snapshot)
+
+# database version adding the source column (see db._MIGRATIONS), the
+# database is created and migrated by the daemon
+_VERSION = 3
+
+
+def _get(path: str, hub: HubConfig) -> dict | None:
+    """Return the data part of the answer of a hub, or None if it failed to
+    answer after all the retries"""
+    for attempt in range(config.domio.retries + 1):
+        if attempt > 0:
+            sleep(config.domio.backoff * 2 ** (attempt - 1))
 
-# # logger initial setup
-# logger = logging.getLogger(__name__)
-# logger.setLevel(logging.INFO)
+        conn = HTTPConnection(
+            hub.hostname, hub.port, timeout=hub.timeout or config.domio.timeout
+        )
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            if resp.status == 200:
+                return json.load(resp)["data"]
+            logger.debug(f"bad status ({resp.status}) when getting {path}")
+            if resp.status < 500:
+                return None
+        except (OSError, HTTPException, ValueError) as exc:
+            logger.debug(f"error when getting {path} ({exc!r})")
+        finally:
+            conn.close()
 
+    logger.warning(f"unable to get {path} from {hub.hostname}:{hub.port}")
+    return None
+
+
+def _connect() -> sqlite3.Connection | None:
+    """Open the database, or return None if it does not exist or is not
+    migrated yet"""
+    try:
+        conn = sqlite3.connect(
+            f"file:{Path(config.database.path).expanduser()}?mode=rw", uri=True,
+            timeout=config.database.busy_timeout / 1000
+        )
+    except sqlite3.Error as exc:
+        logger.error(f"unable to open the database ({exc})")
+        return None
+
+    try:
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+    except sqlite3.Error as exc:
+        logger.error(f"unable to read the database version ({exc})")
+        version = None
+    if version is None or version < _VERSION:
+        if version is not None:
+            logger.error(f"database version {version}, start the daemon to migrate it")
+        conn.close()
+        return None
+    return conn
 
-async def run(config_filename: str):
+
+def run(config_filename: str):
     config.read(config_filename)
 
-    await db.init()
+    rows = []
+    for hub in config.domio.hubs:
+        if "linky" not in hub.tags:
+            continue
+        data = _get("/linky", hub)
+        if data is not None:
+            rows.append((data["east"], int(time()), hub.name or None))
+    if not rows:
+        return
+
+    # store values in db
+    conn = _connect()
+    if conn is None:
+        return
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT INTO linky_snapshot(east, timestamp, source) VALUES (?, ?, ?)",
+                rows
+            )
+    except sqlite3.Error as exc:
+        logger.error(f"error while storing the snapshot ({exc})")
+    finally:
+        conn.close()
+
 
+def backfill(config_filename: str):
+    """Store the missing monthly snapshots, using the first east value of the
+    month found in the archive"""
+    config.read(config_filename)
+
+    conn = _connect()
+    if conn is None:
+        return
     try:
-        async with aiohttp.ClientSession() as session:
-            url = f"http://{config.domio.hostname}:{config.domio.port}/linky"
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    data = (await resp.json())["data"]
-
-                    # store values in db
-                    await db.execute_query(
-                        "INSERT INTO linky_snapshot(east) VALUES (?)", data["east"]
+        for month in archive.months("linky"):
+            start = timegm(strptime(f"{month}-01", "%Y-%m-%d"))
+            year, number = divmod(int(month[5:]), 12)
+            end = timegm(strptime(f"{int(month[:4]) + year}-{number + 1:02}-01", "%Y-%m-%d"))
+
+            # first east value of the month of each meter
+            firsts: dict[str | None, tuple] = {}
+            names = ["timestamp", "east", "source"]
+            for rows in archive.read("linky", names, start, end - 1):
+                for row in rows:
+                    first = firsts.get(row[2])
+                    if row[1] is not None and (first is None or row < first):
+                        firsts[row[2]] = row
+
+            for source, (timestamp, east, _) in firsts.items():
+                exists = conn.execute(
+                    "SELECT 1 FROM linky_snapshot WHERE timestamp >= ? AND timestamp < ? "
+                    "AND source IS ?",
+                    (start, end, source)
+                ).fetchone()
+                if exists:
+                    continue
+
+                with conn:
+                    conn.execute(
+                        "INSERT INTO linky_snapshot(east, timestamp, source) VALUES (?, ?, ?)",
+                        (east, timestamp, source)
                     )
+                logger.info(f"snapshot of {month} ({source or 'domio'}) restored from the archive")
+    except (sqlite3.Error, OSError, ValueError) as exc:
+        logger.error(f"error while restoring the snapshots ({exc})")
     finally:
-        await db.close()
+        conn.close()
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", default="config.toml")
+    parser.add_argument(
+        "--backfill", action="store_true",
+        help="store the missing monthly snapshots from the archived linky rows"
+    )
     args = parser.parse_args()
 
-    asyncio.run(run(args.config))
+    if args.backfill:
+        backfill(args.config)
+    else:
+        run(args.config)
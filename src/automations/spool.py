@@ -0,0 +1,272 @@
+# Append-only log of the rows that could not be written to the database,
+# replayed in bulk once it is available again. The log is a memory-mapped
+# file of fixed size, allocated at once, starting with a format header:
+# records are a header (payload length, crc32) followed by a binary payload:
+# the counts of columns, strings and rows, the table name, the column names
+# and the strings of the rows (length-prefixed UTF-8), then the rows packed
+# with the fixed column types of the table, a text being the index of a
+# string and NULL values flagged in a bit mask. A zero length, a bad checksum
+# or an undecodable payload marks the end of the log, so a record torn by a
+# crash is ignored when the log is recovered at startup
+
+import logging
+import mmap
+import os
+from pathlib import Path
+from struct import error as StructError
+from struct import Struct
+from zlib import crc32
+
+import automations.config as config
+import automations.metrics as metrics
+
+# magic and format version
+_FORMAT = b"DKSPOOL\x02"
+_HEADER = Struct("<II")
+_COUNTS = Struct("<HII")  # columns, strings, rows
+_LENGTH = Struct("<H")
+
+# struct codes of the columns of the spooled tables: q integer, d real,
+# ? boolean, s text
+_TYPES = {
+    "linky": {"east": "q", "sinst": "q", "source": "s", "timestamp": "q"},
+    "linky_snapshot": {"east": "q", "source": "s", "timestamp": "q"},
+    "on_off": {"device": "s", "state": "?", "timestamp": "q"},
+    "pressure": {"pressure": "d", "source": "s", "timestamp": "q"},
+    "rollup": {
+        "series": "s", "resolution": "q", "bucket": "q", "count": "q",
+        "min": "d", "max": "d", "sum": "d", "first": "d", "last": "d"
+    },
+    "temperature_humidity": {
+        "device": "s", "humidity": "d", "source": "s", "temperature": "d", "timestamp": "q"
+    },
+}
+
+# row structs and column codes by (table, columns)
+_structs: dict[tuple, tuple[Struct, str]] = {}
+
+_mm = None
+_offset = 0
+_rows = 0
+
+metrics.gauge(
+    "automations_spool_bytes", "Size of the spooled rows",
+    func=lambda: max(_offset - len(_FORMAT), 0)
+)
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _path() -> Path:
+    return Path(config.spool.path or f"{config.database.path}.spool").expanduser()
+
+
+def init():
+    """Map the spool file, and recover the rows left by the last run"""
+    global _mm
+    global _rows
+
+    if _mm is not None:
+        return
+
+    size = config.spool.max_size
+    try:
+        fd = os.open(_path(), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size > size:
+                # max_size reduced: keep the records that fit
+                os.ftruncate(fd, size)
+            # the blocks are allocated now: on a full disk, a write through
+            # the mapping to a page without storage would raise SIGBUS
+            os.posix_fallocate(fd, 0, size)
+            _mm = mmap.mmap(fd, size)
+        finally:
+            # the mapping keeps its own reference to the file
+            os.close(fd)
+    except OSError as exc:
+        logger.error(f"unable to allocate the spool ({exc}), spooling disabled")
+        return
+
+    if _mm[:len(_FORMAT)] != _FORMAT:
+        if any(_mm[:len(_FORMAT)]):
+            logger.warning("unknown spool format, spooled rows ignored")
+        _mm[:len(_FORMAT) + _HEADER.size] = _FORMAT + bytes(_HEADER.size)
+        _mm.flush()
+
+    _rows = sum(len(rows) for table, _, rows in _records() if table != "rollup")
+    if _rows:
+        logger.info(f"{_rows} spooled rows recovered")
+
+
+def _row_struct(table: str, columns: tuple) -> tuple[Struct, str]:
+    """Return the struct of the rows and the column codes. Raise KeyError for
+    a table or a column without a type"""
+    key = (table, columns)
+    cached = _structs.get(key)
+    if cached is None:
+        types = _TYPES[table]
+        codes = "".join(types[c] for c in columns)
+        # the NULL mask, then the values, the texts being string indexes
+        cached = (Struct("<H" + codes.replace("s", "I")), codes)
+        _structs[key] = cached
+    return cached
+
+
+def _encode(table: str, columns: tuple, rows: list) -> bytes:
+    row_struct, codes = _row_struct(table, columns)
+    strings: dict[str, int] = {}
+    packed = []
+    for row in rows:
+        mask = 0
+        values = []
+        for i, (code, value) in enumerate(zip(codes, row)):
+            if value is None:
+                mask |= 1 << i
+                value = 0
+            elif code == "s":
+                value = strings.setdefault(str(value), len(strings))
+            values.append(value)
+        packed.append(row_struct.pack(mask, *values))
+
+    names = [n.encode() for n in (table, *columns, *strings)]
+    return b"".join((
+        _COUNTS.pack(len(columns), len(strings), len(rows)),
+        *(_LENGTH.pack(len(n)) + n for n in names),
+        *packed
+    ))
+
+
+def _decode(payload: bytes) -> tuple[str, tuple, list]:
+    column_count, string_count, row_count = _COUNTS.unpack_from(payload)
+    offset = _COUNTS.size
+    names = []
+    for _ in range(1 + column_count + string_count):
+        (length,) = _LENGTH.unpack_from(payload, offset)
+        offset += _LENGTH.size
+        names.append(payload[offset:offset + length].decode())
+        offset += length
+    table = names[0]
+    columns = tuple(names[1:1 + column_count])
+    strings = names[1 + column_count:]
+
+    row_struct, codes = _row_struct(table, columns)
+    if len(payload) - offset != row_count * row_struct.size:
+        raise ValueError("bad row count")
+    texts = [i for i, code in enumerate(codes) if code == "s"]
+    rows = []
+    for mask, *values in row_struct.iter_unpack(payload[offset:]):
+        for i in texts:
+            values[i] = strings[values[i]]
+        if mask:
+            for i in range(len(values)):
+                if mask >> i & 1:
+                    values[i] = None
+        rows.append(tuple(values))
+    return table, columns, rows
+
+
+def _records():
+    """Yield the valid records and update `_offset` to the end of the log"""
+    global _offset
+
+    offset = len(_FORMAT)
+    while offset + _HEADER.size <= len(_mm):
+        length, crc = _HEADER.unpack_from(_mm, offset)
+        start = offset + _HEADER.size
+        if length == 0 or start + length > len(_mm):
+            break
+        payload = _mm[start:start + length]
+        try:
+            if crc32(payload) != crc:
+                raise ValueError("bad checksum")
+            table, columns, rows = _decode(payload)
+        except (IndexError, KeyError, StructError, ValueError) as exc:
+            logger.warning(
+                f"spool record at {offset} is corrupted ({exc!r}), ignoring the rest"
+            )
+            break
+        offset = start + length
+        yield table, columns, rows
+
+    _offset = offset
+
+
+def pending() -> int:
+    """Return the number of spooled rows, not counting the rollup aggregates"""
+    return _rows
+
+
+def append(buffer: dict) -> int:
+    """Append the rows of a write-behind buffer ({(table, columns): rows}),
+    return the number of rows that did not fit in the spool (rollup
+    aggregates are not counted)"""
+    global _offset
+    global _rows
+
+    lost = full = 0
+    for (table, columns), rows in buffer.items():
+        # the aggregates are not rows
+        count = 0 if table == "rollup" else len(rows)
+        try:
+            payload = _encode(table, columns, rows)
+        except (KeyError, StructError, ValueError) as exc:
+            logger.error(f"unable to spool {len(rows)} rows of {table} ({exc!r})")
+            lost += count
+            continue
+
+        end = _offset + _HEADER.size + len(payload)
+        if _mm is None or end > len(_mm):
+            full += count
+            continue
+
+        # the payload is written before its header, and the next header is
+        # cleared, so that the log always ends on a complete record
+        _mm[_offset + _HEADER.size:end] = payload
+        if end + _HEADER.size <= len(_mm):
+            _mm[end:end + _HEADER.size] = bytes(_HEADER.size)
+        _HEADER.pack_into(_mm, _offset, len(payload), crc32(payload))
+        _offset = end
+        _rows += count
+
+    if _mm is not None:
+        _mm.flush()
+    if full:
+        logger.error(f"spool full, {full} rows lost")
+    return lost + full
+
+
+def read() -> dict:
+    """Return the spooled rows as a write-behind buffer"""
+    buffer: dict[tuple, list] = {}
+    if _mm is not None:
+        for table, columns, rows in _records():
+            buffer.setdefault((table, columns), []).extend(rows)
+    return buffer
+
+
+def clear():
+    """Empty the spool, once its rows are committed to the database"""
+    global _offset
+    global _rows
+
+    start = len(_FORMAT)
+    if _mm is None or _offset <= start:
+        return
+
+    # clearing the first header empties the log at once
+    _mm[start:start + _HEADER.size] = bytes(_HEADER.size)
+    _mm.flush()
+    _mm[start:_offset] = bytes(_offset - start)
+    _mm.flush()
+    _offset, _rows = start, 0
+
+
+def close():
+    global _mm
+
+    if _mm is not None:
+        _mm.flush()
+        _mm.close()
+        _mm = None
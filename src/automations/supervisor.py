@@ -0,0 +1,128 @@
+import asyncio
+from dataclasses import asdict
+from dataclasses import dataclass
+from functools import partial
+import logging
+from random import uniform
+from time import monotonic
+from time import time
+from typing import Awaitable
+from typing import Callable
+
+import automations.config as config
+import automations.metrics as metrics
+from automations.utils import done_callback
+
+RUNNING = "running"
+BACKOFF = "backoff"
+STOPPED = "stopped"
+
+
+@dataclass
+class TaskHealth:
+    state: str = RUNNING
+    restarts: int = 0
+    last_error: str | None = None
+    # wall clock time of the last (re)start
+    started: float = 0.0
+
+
+_TASK_UP = metrics.gauge("automations_task_up", "1 if the task is running", ("task",))
+
+_health: dict[str, TaskHealth] = {}
+_tasks: dict[str, asyncio.Task] = {}
+
+# logger initial setup
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+async def _supervise(name: str, func: Callable[[], Awaitable], health: TaskHealth):
+    delay = config.supervisor.backoff_initial
+    this_task = asyncio.current_task()
+
+    while True:
+        health.state = RUNNING
+        health.started = time()
+        _TASK_UP.set(1, name)
+        start = monotonic()
+
+        try:
+            await func()
+            if this_task.cancelling():
+                # the task swallowed the cancellation
+                break
+            health.last_error = "task returned"
+            logger.warning(f"task {name} returned")
+        except asyncio.CancelledError:
+            break
+        except Exception as exc:
+            health.last_error = repr(exc)
+            logger.error(
+                f"task {name} failed", exc_info=(type(exc), exc, exc.__traceback__)
+            )
+
+        if monotonic() - start > config.supervisor.stable_after:
+            # the task ran long enough, restart the backoff
+            delay = config.supervisor.backoff_initial
+
+        health.state = BACKOFF
+        health.restarts += 1
+        _TASK_UP.set(0, name)
+        metrics.TASK_RESTARTS.inc(name)
+
+        # equal jitter: at least half the backoff, so that a failing task
+        # never restarts at once, and tasks failing together do not retry
+        # together
+        wait = uniform(delay / 2, delay)
+        logger.info(f"restarting task {name} in {wait:.1f} s")
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            break
+        delay = min(delay * 2, config.supervisor.backoff_max)
+
+    health.state = STOPPED
+    _TASK_UP.set(0, name)
+
+
+def start(name: str, func: Callable[[], Awaitable]):
+    """Run the coroutine function `func` in a task restarted with a jittered
+    exponential backoff when it fails or returns"""
+    if name in _tasks:
+        return
+
+    health = TaskHealth()
+    _health[name] = health
+    task = asyncio.create_task(_supervise(name, func, health), name=name)
+    task.add_done_callback(partial(done_callback, logger))
+    _tasks[name] = task
+
+
+async def stop(name: str):
+    task = _tasks.pop(name, None)
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            # task exceptions are handled by the done callback
+            pass
+
+
+def health() -> dict:
+    """Return the health of the supervised tasks"""
+    return {name: asdict(h) for name, h in _health.items()}
+
+
+def _check() -> tuple[bool, dict]:
+    ok = all(h.state == RUNNING for name, h in _health.items() if name in _tasks)
+    return ok, health()
+
+
+metrics.add_health_check("tasks", _check)
+
+
+async def close():
+    for name in list(_tasks):
+        await stop(name)
@@ -1,28 +1,26 @@
-import asyncio
-from datetime import date
-from datetime import datetime
-from datetime import timedelta
-from functools import partial
-from time import perf_counter
-import json
 import logging
-
-import aiohttp
-import aiomqtt
-import aiosmtplib
-from email.message import EmailMessage
-from paho.mqtt.subscribeoptions import SubscribeOptions
+from time import time
 
 import automations.config as config
-from automations.db import execute_query
-from automations.utils import done_callback
-
-_check_time = None
-_running = False
-_task_linky = None
-_task_mqtt = None
-_task_outdoor = None
-_task_pressure = None
+import automations.deadband as deadband
+import automations.decoders as decoders
+import automations.domio as domio
+from automations.db import insert
+from automations.filters import OutlierFilter
+import automations.outbox as outbox
+import automations.registry as registry
+import automations.retention as retention
+import automations.router as router
+import automations.rules as rules
+import automations.scheduler as scheduler
+import automations.supervisor as supervisor
+
+_outlier_filters: dict[tuple[str, str], OutlierFilter] = {}
+
+# MQTT connection and its subscriptions, aligned with the router filters when
+# the rules are reloaded
+_client = None
+_subscribed: set[str] = set()
 
 # logger initial setup
 logger = logging.getLogger(__name__)
@@ -30,271 +28,210 @@ logger.setLevel(logging.INFO)
 
 
 def init():
-    global _check_time
-    global _task_linky
-    global _task_mqtt
-    global _task_outdoor
-    global _task_pressure
-    global _running
+    domio.init()
+    registry.init()
 
-    _running = True
+    router.register("zigbee2mqtt/sensor/sonoff/snzb02p/#", _on_snzb02p)
+    rules.init()
 
-    if _task_linky  is None:
-        _task_linky = asyncio.create_task(_linky_task())
-        _task_linky.add_done_callback(partial(done_callback, logger))
+    # reconnects to the broker when the connection is lost, subscribing again
+    # to the router filters
+    supervisor.start("mqtt", _mqtt_task)
 
-    if _task_mqtt  is None:
-        _task_mqtt = asyncio.create_task(_mqtt_task())
-        _task_mqtt.add_done_callback(partial(done_callback, logger))
+    _schedule_polls()
+    scheduler.add_interval("retention", config.retention.interval, retention.run, delay=60)
 
-    if _task_outdoor  is None:
-        _task_outdoor = asyncio.create_task(_outdoor_task())
-        _task_outdoor.add_done_callback(partial(done_callback, logger))
 
-    if _task_pressure  is None:
-        _task_pressure = asyncio.create_task(_pressure_task())
-        _task_pressure.add_done_callback(partial(done_callback, logger))
+def _schedule_polls():
+    scheduler.add_interval("linky", config.periodicity.linky, _poll_linky)
+    scheduler.add_interval("outdoor", config.periodicity.outdoor, _poll_outdoor)
+    scheduler.add_interval("pressure", config.periodicity.pressure, _poll_pressure)
 
-    _check_time = datetime.strptime(config.linky.check_time, "%H:%M").time()
 
+async def reload(changed: list[str]):
+    """Reconfigure in place what depends on the `changed` configuration
+    sections. The other sections are read when used"""
+    if "domio" in changed:
+        # the polls in progress fail, and run again at their next period
+        await domio.close()
+        domio.init()
+
+    if "filters" in changed:
+        _outlier_filters.clear()
+
+    if "periodicity" in changed:
+        _schedule_polls()
+
+    if "registry" in changed:
+        if config.registry.enabled:
+            registry.schedule()
+        else:
+            registry.unschedule()
+
+    if "retention" in changed:
+        scheduler.add_interval("retention", config.retention.interval, retention.run)
+
+    if "rules" in changed:
+        try:
+            await rules.reload()
+        except ValueError as exc:
+            logger.error(f"{exc}, the current rules are kept")
+        else:
+            await _subscribe()
+
+
+async def _subscribe():
+    """Subscribe to the router filters added since the connection to the
+    broker, and unsubscribe from the removed ones"""
+    global _subscribed
+
+    if _client is None:
+        # subscribed when connecting
+        return
+
+    from paho.mqtt.subscribeoptions import SubscribeOptions
+
+    wanted = set(router.filters())
+    options = SubscribeOptions(qos=1, noLocal=True)
+    for topic_filter in wanted - _subscribed:
+        await _client.subscribe(topic_filter, options=options)
+    for topic_filter in _subscribed - wanted:
+        await _client.unsubscribe(topic_filter)
+    _subscribed = wanted
+
+
+def _accept(device: str, **values) -> bool:
+    """Pass the values of a device through their outlier filters, return
+    False if one of them is rejected"""
+    accepted = True
+    for name, value in values.items():
+        min_deviation = config.filters.min_deviation.get(name)
+        if min_deviation is None:
+            continue
+
+        outlier_filter = _outlier_filters.get((device, name))
+        if outlier_filter is None:
+            outlier_filter = OutlierFilter(
+                config.filters.outlier_alpha, config.filters.outlier_threshold,
+                min_deviation, config.filters.max_rejections
+            )
+            _outlier_filters[(device, name)] = outlier_filter
+
+        if outlier_filter.update(value) is None:
+            logger.debug(f"{device}: {name} outlier rejected ({value})")
+            accepted = False
+
+    return accepted
 
-async def _send_email(subject: str, content: str):
-    message = EmailMessage()
-    message["From"] = config.secret.mail_from,
-    message["To"] = config.secret.mail_to
-    message["Subject"] = subject
-    message.set_content(content)
-    try:
-        await aiosmtplib.send(
-            message,
-            hostname=config.smtp.hostname,
-            port=config.smtp.port,
-            username=config.secret.smtp_username,
-            password=config.secret.smtp_password
-        )
-    except Exception as exc:
-        logger.error(f"{exc}")
+
+async def _store(table: str, source: str, /, **values):
+    await rules.sample(source, **values)
+    registry.update(source, **{k: v for k, v in values.items() if k not in ("device", "source")})
+
+    # every sample is aggregated in the rollups, but the samples staying in
+    # their deadband are not stored
+    values.setdefault("timestamp", int(time()))
+    await insert(table, store=False, **values)
+    for row in deadband.process(table, **values):
+        await insert(table, aggregate=False, **row)
 
 
 async def _mqtt_task():
+    global _client
+    global _subscribed
+
+    # imported here, like the other heavy dependencies, to keep the startup
+    # fast (see main.py --import-report)
+    import aiomqtt
+    from paho.mqtt.subscribeoptions import SubscribeOptions
+
     logger.debug("mqtt task started")
 
-    async with aiomqtt.Client(
-        config.mqtt.hostname, config.mqtt.port, protocol=aiomqtt.ProtocolVersion.V5
-    ) as client:
-        options = SubscribeOptions(qos=1, noLocal=True)
-        await client.subscribe("home/#", options=options)
-        await client.subscribe("zigbee2mqtt/sensor/#")
-        try:
-            async for message in client.messages:
-                logger.debug(
-                    f"mqtt message, topic: {message.topic.value}, "
-                    f"payload: {message.payload}"
-                )
-                if message.topic.matches("zigbee2mqtt/sensor/sonoff/snzb02p/#"):
-                    if message.payload is None:
-                        continue
-
-                    payload = json.loads(message.payload.decode())
-                    device = message.topic.value.split('/')[-1]
-
-                    # store values in db
-                    try:
-                        await execute_query(
-                            "INSERT INTO temperature_humidity "
-                            "(device, humidity, temperature) VALUES (?, ?, ?)",
-                            device, payload["humidity"], payload["temperature"]
-                        )
-
-                        if payload["battery"] < 50:
-                            logger.warning(f"{message.topic.value}: battery low")
-                    except KeyError as exc:
-                        logger.debug(f"incomplete data: missing {exc} key")
-                elif message.topic.matches("home/doorbell/pressed"):
-                    await client.publish(
-                        "home/doorbell/ring",
-                        payload=json.dumps({"number": 5})
-                    )
-                    await _send_email("Ding dong !", "On sonne à la porte")
-
-                    # store event in db
-                    await execute_query(
-                        "INSERT INTO on_off(device, state) VALUES (?, ?)",
-                        "doorbell", True
-                    )
-
-        except (asyncio.CancelledError, KeyboardInterrupt):
-            pass
-
-    logger.debug("mqtt task stopped")
-
-
-async def _linky_task():
-    logger.debug("linky task started")
-
-    power_alert = False
-
-    start_time = perf_counter()
-    try:
-        while _running:
-            if perf_counter() - start_time >= config.periodicity.linky:
-                start_time = perf_counter()
-
-                async with aiohttp.ClientSession() as session:
-                    url = f"http://{config.domio.hostname}:{config.domio.port}/linky"
-                    async with session.get(url) as resp:
-                        if resp.status == 200:
-                            data = (await resp.json())["data"]
-                            sinst = data["sinsts"]
-
-                            # store values in db
-                            await execute_query(
-                                "INSERT INTO linky(east, sinst) VALUES (?, ?)",
-                                data["east"], sinst
-                            )
-
-                            # check apparent power
-                            check_datetime = datetime.combine(date.today(), _check_time)
-                            if abs(datetime.now() - check_datetime) < timedelta(minutes=1):
-                                if sinst > config.linky.apparent_power_alert:
-                                    if not power_alert:
-                                        logger.warning("apparent power alert!")
-
-                                        # ring the bell once
-                                        async with aiomqtt.Client(
-                                            config.mqtt.hostname, config.mqtt.port,
-                                            protocol=aiomqtt.ProtocolVersion.V5
-                                        ) as client:
-                                            await client.publish(
-                                                "home/doorbell/ring",
-                                                payload=json.dumps({"number": 1})
-                                            )
-
-                                        # and send an email
-                                        await _send_email(
-                                            "Alerte consommation !",
-                                            "Consommation électrique inhabituelle"
-                                        )
-
-                                        power_alert = True
-                                else:
-                                    power_alert = False
-                        else:
-                            logger.debug(f"bad status ({resp.status}) when getting linky")
-
-            await asyncio.sleep(1)
-    except (asyncio.CancelledError, KeyboardInterrupt):
-        pass
-
-    logger.debug("linky task stopped")
-
-
-async def _outdoor_task():
-    logger.debug("outdoor task started")
-
-    start_time = perf_counter()
-    try:
-        while _running:
-            if perf_counter() - start_time >= config.periodicity.outdoor:
-                start_time = perf_counter()
-
-                async with aiohttp.ClientSession() as session:
-                    url = f"http://{config.domio.hostname}:{config.domio.port}/outdoor"
-                    async with session.get(url) as resp:
-                        if resp.status == 200:
-                            data = (await resp.json())["data"]
-                            humidity = data["humidity"]
-                            temperature = data["temperature"]
-
-                            # store values in db
-                            await execute_query(
-                                (
-                                    "INSERT INTO temperature_humidity(device, humidity, temperature) "
-                                    "VALUES ('outdoor', ?, ?)"
-                                ),
-                                humidity, temperature
-                            )
-                        else:
-                            logger.debug(
-                                f"bad status ({resp.status}) when getting outdoor data"
-                            )
-
-            await asyncio.sleep(1)
-    except (asyncio.CancelledError, KeyboardInterrupt):
-        pass
-
-    logger.debug("outdoor task stopped")
-
-
-async def _pressure_task():
-    logger.debug("pressure task started")
-
-    start_time = perf_counter()
     try:
-        while _running:
-            if perf_counter() - start_time >= config.periodicity.pressure:
-                start_time = perf_counter()
+        async with aiomqtt.Client(
+            config.mqtt.hostname, config.mqtt.port, protocol=aiomqtt.ProtocolVersion.V5
+        ) as client:
+            options = SubscribeOptions(qos=1, noLocal=True)
+            _subscribed = set(router.filters())
+            for topic_filter in _subscribed:
+                await client.subscribe(topic_filter, options=options)
+            outbox.set_mqtt_client(client)
+            _client = client
+
+            async for message in client.messages:
+                router.dispatch(message)
+    finally:
+        # the supervisor restarts the task if the connection is lost
+        _client = None
+        outbox.set_mqtt_client(None)
+        logger.debug("mqtt task stopped")
+
+
+async def _on_snzb02p(message):
+    # malformed payloads are counted by the decoder
+    record = decoders.decode("snzb02p", message.payload)
+    if record is None:
+        return
+
+    device = message.topic.value.split('/')[-1]
+    registry.update(device, battery=record.battery, linkquality=record.linkquality)
+
+    # store values in db
+    humidity = record.humidity
+    temperature = record.temperature
+    if _accept(device, humidity=humidity, temperature=temperature):
+        await _store(
+            "temperature_humidity", device, device=device,
+            humidity=humidity, temperature=temperature
+        )
 
-                async with aiohttp.ClientSession() as session:
-                    url = f"http://{config.domio.hostname}:{config.domio.port}/pressure"
-                    async with session.get(url) as resp:
-                        if resp.status == 200:
-                            data = (await resp.json())["data"]
-                            pressure = data["pressure"]
-                            pressure /= 100.0  # convert to hPa
 
-                            # store values in db
-                            await execute_query(
-                                "INSERT INTO pressure(pressure) VALUES (?)", pressure
-                            )
-                        else:
-                            logger.debug(f"bad status ({resp.status}) when getting pressure")
+def _tagged(hub, sensor: str) -> tuple[str, dict]:
+    """Return the source of the samples of a hub sensor (for the rules and
+    the outlier filters) and the columns tagging its rows"""
+    if not hub.name:
+        return sensor, {}
+    return f"{hub.name}.{sensor}", {"source": hub.name}
 
-            await asyncio.sleep(1)
-    except (asyncio.CancelledError, KeyboardInterrupt):
-        pass
 
-    logger.debug("pressure task stopped")
+async def _poll_linky():
+    async for hub, data in domio.gather("/linky", "linky"):
+        source, tags = _tagged(hub, "linky")
+        # store values in db
+        await _store("linky", source, east=data["east"], sinst=data["sinsts"], **tags)
 
 
-async def close():
-    global _running
-    global _task_linky
-    global _task_mqtt
-    global _task_outdoor
-    global _task_pressure
+async def _poll_outdoor():
+    async for hub, data in domio.gather("/outdoor", "outdoor"):
+        source, tags = _tagged(hub, "outdoor")
+        humidity = data["humidity"]
+        temperature = data["temperature"]
+        if _accept(source, humidity=humidity, temperature=temperature):
+            # store values in db
+            await _store(
+                "temperature_humidity", source, device="outdoor",
+                humidity=humidity, temperature=temperature, **tags
+            )
 
-    _running = False
 
-    if _task_linky is not None:
-        try:
-            await _task_linky
-        except Exception:
-            # task exceptions are handled by the done callback
-            pass
-        _task_linky = None
+async def _poll_pressure():
+    async for hub, data in domio.gather("/pressure", "pressure"):
+        source, tags = _tagged(hub, "pressure")
+        pressure = data["pressure"]
+        pressure /= 100.0  # convert to hPa
 
-    if _task_mqtt is not None:
-        try:
-            _task_mqtt.cancel()
-            await _task_mqtt
-        except Exception:
-            # task exceptions are handled by the done callback
-            pass
-        _task_mqtt = None
-
-    if _task_outdoor is not None:
-        try:
-            await _task_outdoor
-        except Exception:
-            # task exceptions are handled by the done callback
-            pass
-        _task_outdoor = None
+        # store values in db
+        await _store("pressure", source, pressure=pressure, **tags)
 
-    if _task_pressure is not None:
-        try:
-            await _task_pressure
-        except Exception:
-            # task exceptions are handled by the done callback
-            pass
-        _task_pressure = None
+
+async def close():
+    await scheduler.close()
+    await supervisor.stop("mqtt")
+
+    await router.close()
+    rules.close()
+    await registry.close()
+    await domio.close()
+
+    for table, row in deadband.flush():
+        await insert(table, aggregate=False, **row)
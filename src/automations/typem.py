@@ -1,21 +1,104 @@
 from dataclasses import dataclass
+from dataclasses import field
+
+
+@dataclass
+class ApiConfig:
+    enabled: bool = True
+    hostname: str = "127.0.0.1"
+    port: int = 8102
+    # rows fetched from the cursor and written per chunk
+    chunk_size: int = 500
+    # maximum number of points of a LTTB downsampling
+    max_points: int = 10000
+
+
+@dataclass
+class ArchiveConfig:
+    # rows deleted by the retention are archived before, for these tables
+    enabled: bool = True
+    path: str = "~/.local/share/automations/archive"
+    tables: list = field(default_factory=list)
+    # rows read from the database per archive block, at most
+    chunk_rows: int = 50000
 
 
 @dataclass
 class DatabaseConfig:
     path: str
+    batch_size: int = 50
+    batch_max_age: float = 5.0
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    mmap_size: int = 268435456
+    cache_size: int = -16384
+    busy_timeout: int = 5000
+    readers: int = 2
+
+
+@dataclass
+class DeadbandConfig:
+    # maximum time between two stored samples of a series (seconds)
+    heartbeat: int = 900
+    # "table" or "table.device" -> heartbeat
+    heartbeats: dict = field(default_factory=dict)
+    # "table.column" or "table.device.column" -> threshold
+    thresholds: dict = field(default_factory=dict)
+
+
+@dataclass
+class DiagnosticsConfig:
+    # event loop stalls longer than this are reported (seconds)
+    slow_threshold: float = 0.1
+    sample_interval: float = 0.01
+    tick_interval: float = 0.05
+    output_dir: str = "/tmp"
 
 
 @dataclass
 class DomioConfig:
+    # single hub, whose rows are not tagged (when no hubs are declared)
+    hostname: str = "localhost"
+    port: int = 8100
+    pool_size: int = 4
+    timeout: float = 10.0
+    retries: int = 2
+    backoff: float = 1.0
+    # maximum number of hubs polled at the same time
+    concurrency: int = 8
+    # HubConfig list
+    hubs: list = field(default_factory=list)
+
+
+@dataclass
+class FilterConfig:
+    outlier_alpha: float = 0.05
+    outlier_threshold: float = 5.0
+    max_rejections: int = 5
+    # field -> minimum deviation of an outlier, fields not listed are not
+    # filtered
+    min_deviation: dict = field(default_factory=dict)
+
+
+@dataclass
+class HubConfig:
+    # source of the rows of the hub, empty for the untagged legacy hub
+    name: str
     hostname: str
-    port: int
+    port: int = 8100
+    # sensors polled on the hub
+    tags: list = field(default_factory=lambda: ["linky", "outdoor", "pressure"])
+    # overrides the domio timeout for a slow hub
+    timeout: float | None = None
 
 
 @dataclass
-class LinkyConfig:
-    apparent_power_alert: int
-    check_time: str
+class MetricsConfig:
+    enabled: bool = True
+    hostname: str = "127.0.0.1"
+    port: int = 8101
+    lag_interval: float = 1.0
+
 
 @dataclass
 class MqttConfig:
@@ -23,6 +106,15 @@ class MqttConfig:
     port: int
 
 
+@dataclass
+class OutboxConfig:
+    coalesce_window: float = 30.0
+    retry_delay: float = 60.0
+    mqtt_max_age: float = 60.0
+    smtp_timeout: float = 30.0
+    smtp_idle_timeout: float = 120.0
+
+
 @dataclass
 class PeriodicityConfig:
     linky: int
@@ -30,6 +122,55 @@ class PeriodicityConfig:
     pressure: int
 
 
+@dataclass
+class RegistryConfig:
+    enabled: bool = True
+    # snapshot of the device states, "<database path>.registry.json" if empty
+    path: str = ""
+    snapshot_interval: float = 300.0
+    # seconds without news of a device before an alert, 0 to disable
+    stale_after: float = 3600.0
+    # device -> seconds, overrides stale_after
+    stale: dict = field(default_factory=dict)
+    check_interval: float = 60.0
+    # fields notified at each update, even when their value is unchanged
+    events: list = field(default_factory=lambda: ["state"])
+
+
+@dataclass
+class ReportsConfig:
+    # worker processes computing the days, one per CPU if 0
+    workers: int = 0
+    email: bool = True
+    # directory of the report files, no files if empty
+    output_dir: str = ""
+
+
+@dataclass
+class RetentionConfig:
+    # table -> days
+    tables: dict = field(default_factory=dict)
+    # rollup resolution (minute, hour, day) -> days
+    rollup: dict = field(default_factory=dict)
+    interval: int = 3600
+    batch_size: int = 500
+    pause: float = 0.05
+    vacuum_pages: int = 256
+
+
+@dataclass
+class RuleConfig:
+    name: str
+    # {topic = filter}, {cron = expression, source = name} or
+    # {source = name, field = name, above|below = threshold}
+    trigger: dict
+    # {publish = topic, payload, key}, {email = subject, content, key},
+    # {insert = table, values} or {log = message, level}
+    actions: list
+    # {field = name, op = operator, value = value}, all must be true
+    conditions: list = field(default_factory=list)
+
+
 class SecretConfig:
     pass
 
@@ -38,3 +179,22 @@ class SecretConfig:
 class SmtpConfig:
     hostname: str
     port: int
+
+
+@dataclass
+class SpoolConfig:
+    # next to the database file by default
+    path: str = ""
+    # bytes, rows are lost when the spool is full
+    max_size: int = 16777216
+    # delay between two attempts to open the database (seconds)
+    retry_interval: float = 30.0
+
+
+@dataclass
+class SupervisorConfig:
+    # delay before the first restart, doubled at each failure (seconds)
+    backoff_initial: float = 1.0
+    backoff_max: float = 300.0
+    # a task running longer than this restarts with the initial backoff
+    stable_after: float = 60.0
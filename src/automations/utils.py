@@ -1,6 +1,8 @@
 import asyncio
+from collections import deque
 import dataclasses
 import json
+from math import fsum
 
 
 class EnhancedJSONEncoder(json.JSONEncoder):
@@ -19,10 +21,16 @@ async def exec_cmd(cmd: str) -> tuple[int | None, str, str]:
 
 
 class ValueFilter:
+    """Moving average over the last `size` values, O(1) per update"""
+
+    __slots__ = ("__count", "__mean", "__size", "__sum", "__values")
+
     def __init__(self, size: int):
         self.__size = size
-        self.__list = []  # type: ignore[var-annotated]
+        self.__values = deque(maxlen=size)  # type: ignore[var-annotated]
+        self.__sum = 0
         self.__mean = 0
+        self.__count = 0
 
     @property
     def size(self):
@@ -34,16 +42,27 @@ class ValueFilter:
 
     @value.setter
     def value(self, v):
-        self.__list.insert(0, v)
-        if len(self.__list) > self.__size:
-            self.__list.pop(-1)
-        self.__mean = sum(self.__list) / len(self.__list)
+        if len(self.__values) == self.__size:
+            self.__sum -= self.__values[0]
+        self.__values.append(v)
+
+        self.__count += 1
+        if self.__count >= self.__size:
+            # recompute the sum from time to time so that float rounding
+            # errors do not accumulate (amortized O(1))
+            self.__count = 0
+            self.__sum = fsum(self.__values)
+        else:
+            self.__sum += v
+        self.__mean = self.__sum / len(self.__values)
 
 
 def done_callback(logger, task):
     """This function enable logging exceptions in tasks. It must be overloaded
     as a partial function where the logger is imposed"""
+    if task.cancelled():
+        return
     exc = task.exception()
-    if exc is not None and not isinstance(exc, asyncio.exceptions.CancelledError):
+    if exc is not None:
         exc_info = (type(exc), exc, exc.__traceback__)
         logger.error(exc, exc_info=exc_info)
@@ -0,0 +1,50 @@
+import asyncio
+from pathlib import Path
+import sqlite3
+
+import automations.config as config
+import automations.db as db
+import automations.tasks as tasks
+
+CONFIG = Path(__file__).resolve().parents[1] / "config.toml"
+
+
+def _config(tmp_path: Path) -> Path:
+    (tmp_path / "database").mkdir()
+    filename = tmp_path / "config.toml"
+    filename.write_text(CONFIG.read_text().replace("/home/domotik/", f"{tmp_path}/"))
+    return filename
+
+
+async def _store_minute(filename: Path, start: int):
+    config.read(filename)
+    await db.init()
+    try:
+        # a constant pressure, sampled every second, with one excursion
+        for i in range(60):
+            pressure = 1030.0 if i == 30 else 1010.0
+            await tasks._store("pressure", "pressure", pressure=pressure, timestamp=start + i)
+    finally:
+        await db.close()
+
+
+def test_minute_mean_of_deadband_samples(tmp_path):
+    start = 1_800_000_000 - 1_800_000_000 % 60
+    filename = _config(tmp_path)
+    asyncio.run(_store_minute(filename, start))
+
+    conn = sqlite3.connect(config.database.path)
+    try:
+        (stored,) = conn.execute("SELECT COUNT(*) FROM pressure").fetchone()
+        count, mean = conn.execute(
+            "SELECT count, sum / count FROM rollup "
+            "WHERE series = 'pressure.pressure' AND resolution = 60 AND bucket = ?",
+            (start,)
+        ).fetchone()
+    finally:
+        conn.close()
+
+    # the deadband stores the changes only, the rollup aggregates every sample
+    assert stored < 60
+    assert count == 60
+    assert abs(mean - (59 * 1010.0 + 1030.0) / 60) < 1e-9